@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import calendar
+import hashlib
+import json
+import mmap
+import os
+import threading
+import time
+import zlib
+
+DEFAULT_ARCHIVE_DIR = "archive"
+IDNAME_PARTITION = "idname"
+# top-level response fields that change on every request (the request
+# time) and are left out of the digest that detects repeated fetches
+VOLATILE_KEYS = ("requested",)
+
+def content_digest(bodies):
+    """Digest of the pages of a fetch, ignoring VOLATILE_KEYS."""
+    h = hashlib.blake2b(digest_size=16)
+    for body in bodies:
+        try:
+            doc = json.loads(body)
+        except ValueError:
+            doc = None
+        if isinstance(doc, dict):
+            for key in VOLATILE_KEYS:
+                doc.pop(key, None)
+            body = json.dumps(doc, sort_keys=True).encode("utf-8")
+        h.update(len(body).to_bytes(8, "big"))
+        h.update(body)
+    return h.hexdigest()
+
+class ResponseArchive:
+    """Append-only archive of raw Zaim API responses.
+
+    Every partition (a month "YYYY-MM", or "idname" for the category and
+    genre maps) is a file of concatenated zlib streams, one per response
+    page, plus a JSON lines index of their offsets. The index lines of a
+    fetch are written after all of its data, so a fetch interrupted
+    halfway is never replayed.
+
+    A fetch whose pages equal the last archived fetch of the same span is
+    not stored again, so polling an unchanged month does not grow the
+    archive.
+    """
+    def __init__(self, archive_dir=DEFAULT_ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self.lock = threading.Lock()
+        # {(partition, meta) : digest of the last fetch}, filled from the
+        # index on the first append to a partition
+        self.__last_digests = {}
+        self.__loaded = set()
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+
+    def data_path(self, partition):
+        return os.path.join(self.archive_dir, partition + ".zz")
+
+    def index_path(self, partition):
+        return os.path.join(self.archive_dir, partition + ".idx")
+
+    def partitions(self):
+        return sorted(f[:-4] for f in os.listdir(self.archive_dir) if f.endswith(".idx"))
+
+    def append(self, partition, meta, bodies):
+        """Archives the raw bodies of one fetch; meta is stored with each page.
+
+        Returns False when the fetch repeats the last one of the same meta
+        and nothing was written.
+        """
+        fetched_at = time.time()
+        digest = content_digest(bodies)
+        key = (partition, json.dumps(meta, sort_keys=True))
+        index = []
+        with self.lock:
+            if partition not in self.__loaded:
+                self.__load_last_digests(partition)
+            if self.__last_digests.get(key) == digest:
+                return False
+            with open(self.data_path(partition), "ab") as f:
+                offset = f.tell()
+                for page, body in enumerate(bodies, 1):
+                    data = zlib.compress(body)
+                    f.write(data)
+                    index.append(dict(meta, fetched_at=fetched_at, page=page,
+                                      offset=offset, length=len(data), digest=digest))
+                    offset += len(data)
+                f.flush()
+                os.fsync(f.fileno())
+            with open(self.index_path(partition), "a") as f:
+                for rec in index:
+                    f.write(json.dumps(rec) + "\n")
+            self.__last_digests[key] = digest
+        return True
+
+    def __load_last_digests(self, partition):
+        # later records of the same meta overwrite earlier ones
+        self.__loaded.add(partition)
+        for rec in self.read_index(partition):
+            meta = {k : v for k, v in rec.items()
+                    if k not in ("fetched_at", "page", "offset", "length", "digest")}
+            self.__last_digests[(partition, json.dumps(meta, sort_keys=True))] = rec.get("digest")
+
+    def read_index(self, partition):
+        try:
+            with open(self.index_path(partition), "r") as f:
+                return [json.loads(line) for line in f if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def iter_bodies(self, partition, records):
+        """Yields the decompressed body of each index record, in order."""
+        if not records:
+            return
+        with open(self.data_path(partition), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for rec in records:
+                    yield zlib.decompress(mm[rec["offset"] : rec["offset"] + rec["length"]])
+
+def month_span(month, start_date, end_date):
+    """Returns the part of start_date .. end_date within month (YYYY-MM)."""
+    last_day = calendar.monthrange(int(month[:4]), int(month[5:]))[1]
+    return max(start_date, month + "-01"), min(end_date, "{}-{:02d}".format(month, last_day))
+
+class ArchiveReplay:
+    """Reads entries from a ResponseArchive instead of the Zaim API.
+
+    Offers get_entries/iter_entries/iter_shards like ZaimAPI; for each
+    month the newest archived fetch covering the span is used.
+    """
+    def __init__(self, archive_dir=DEFAULT_ARCHIVE_DIR, cache_path=None):
+        self.archive = ResponseArchive(archive_dir)
+        self.categories = {}
+        self.genres = {}
+        self.__load_idname(cache_path)
+
+    def __load_idname(self, cache_path):
+        """Takes the newest archived category/genre maps, falling back on
+        ZaimAPI's id->name cache file for whatever is not archived."""
+        newest = {}
+        for rec in self.archive.read_index(IDNAME_PARTITION):
+            newest[rec["kind"]] = rec
+        for kind, rec in newest.items():
+            for body in self.archive.iter_bodies(IDNAME_PARTITION, [rec]):
+                d = {i["id"] : i["name"] for i in json.loads(body)[kind]}
+            setattr(self, kind, d)
+        if len(newest) < 2 and cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, "r") as f:
+                cache = json.load(f)
+            for kind in ("categories", "genres"):
+                if kind not in newest:
+                    setattr(self, kind, {int(k) : v for k, v in cache[kind].items()})
+
+    def get_category(self, cat_id):
+        return self.categories.get(cat_id, "")
+
+    def get_genre(self, genre_id):
+        return self.genres.get(genre_id, "")
+
+    def get_entries(self, start_date, end_date):
+        return list(self.iter_entries(start_date, end_date))
+
+    def iter_entries(self, start_date, end_date, oldest_first=False):
+        """Yields entries between start_date and end_date, newest first
+        unless oldest_first."""
+        for shard_start, shard_end, entries in self.iter_shards(start_date, end_date,
+                                                                oldest_first=oldest_first):
+            yield from entries
+
+    def iter_shards(self, start_date, end_date, annotate=True, oldest_first=False):
+        """Yields (shard_start, shard_end, entries) newest first unless
+        oldest_first."""
+        months = [m for m in self.archive.partitions()
+                  if m != IDNAME_PARTITION and start_date[:7] <= m <= end_date[:7]]
+        for month in (months if oldest_first else reversed(months)):
+            shard_start, shard_end = month_span(month, start_date, end_date)
+            records = self.__select_fetch(month, shard_start, shard_end)
+            entries = []
+            for body in self.archive.iter_bodies(month, records):
+                entries.extend(e for e in json.loads(body)["money"]
+                               if shard_start <= e["date"] <= shard_end)
+            if oldest_first:
+                entries.reverse()
+            if annotate:
+                self.annotate_entries(entries)
+            yield shard_start, shard_end, entries
+
+    def missing_months(self, start_date, end_date):
+        """Returns the months (YYYY-MM) of the span that no archived fetch
+        covers, even partially."""
+        missing = []
+        year, month = int(start_date[:4]), int(start_date[5:7])
+        while "{}-{:02d}".format(year, month) <= end_date[:7]:
+            ym = "{}-{:02d}".format(year, month)
+            shard_start, shard_end = month_span(ym, start_date, end_date)
+            if not any(rec["start_date"] <= shard_end and shard_start <= rec["end_date"]
+                       for rec in self.archive.read_index(ym)):
+                missing.append(ym)
+            year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+        return missing
+
+    def __select_fetch(self, month, start_date, end_date):
+        """Returns the page records of the newest fetch covering the span."""
+        fetches = {}
+        for rec in self.archive.read_index(month):
+            fetches.setdefault(rec["fetched_at"], []).append(rec)
+        newest = None
+        for fetched_at in sorted(fetches, reverse=True):
+            rec = fetches[fetched_at][0]
+            if rec["start_date"] <= start_date and end_date <= rec["end_date"]:
+                return fetches[fetched_at]
+            if newest is None and rec["start_date"] <= end_date and start_date <= rec["end_date"]:
+                newest = fetches[fetched_at]
+        if newest is not None:
+            print("warning: {} .. {} is only partially archived".format(start_date, end_date))
+            return newest
+        return []
+
+    def annotate_entries(self, entries):
+        for e in entries:
+            e["category"] = self.get_category(e["category_id"])
+            e["genre"] = self.get_genre(e["genre_id"])
+
+#-----------------------------------------------#
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="list the partitions of a Zaim response archive")
+    parser.add_argument("archive_dir", type=str, nargs="?", default=DEFAULT_ARCHIVE_DIR)
+    flags = parser.parse_args()
+
+    archive = ResponseArchive(flags.archive_dir)
+    for partition in archive.partitions():
+        records = archive.read_index(partition)
+        fetches = len(set(r["fetched_at"] for r in records))
+        size = os.path.getsize(archive.data_path(partition))
+        print("{:>8} {:>4} fetches {:>6} pages {:>10} bytes".format(partition, fetches, len(records), size))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import calendar
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+import archive
+import ratelimit
+from zaimapi import ZaimAPI, ZaimLocalDB, month_shards
+
+# Rebuilds zaim.db from Zaim, one job per month:
+#
+#   ./backfill.py 2017-01-01
+#
+# Months are fetched in parallel and written into <db>.backfill, each in
+# one transaction together with its checkpoint; rerunning after an
+# interruption fetches only the missing months. When every month is done
+# the rebuilt database replaces <db> with os.replace.
+
+DEFAULT_WORKERS = 4
+
+def pending_jobs(zldb, start_date, end_date):
+    """Returns the month spans that have no checkpoint for the same span."""
+    done = zldb.backfill_checkpoints()
+    return [(s, e) for s, e in month_shards(start_date, end_date)
+            if done.get(s[:7]) != (s, e)]
+
+def backfill(z, staging_path, start_date, end_date, workers):
+    """Fetches every pending month on `workers` threads into staging_path.
+
+    The sqlite3 connection stays on the calling thread, which writes each
+    month as soon as it is fetched. Returns the months that failed.
+    """
+    failed = []
+    with ZaimLocalDB(staging_path) as zldb:
+        jobs = pending_jobs(zldb, start_date, end_date)
+        total = len(month_shards(start_date, end_date))
+        print("{} of {} months to fetch".format(len(jobs), total))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(z.fetch_shard, s, e) : (s, e) for s, e in jobs}
+            for i, future in enumerate(as_completed(futures), 1):
+                shard_start, shard_end = futures[future]
+                try:
+                    entries = future.result()
+                except Exception as e:
+                    failed.append(shard_start[:7])
+                    print("[{}/{}] {}: failed: {!r}".format(i, len(jobs), shard_start[:7], e))
+                    continue
+                try:
+                    zldb.sync_entries(shard_start, shard_end, entries)
+                    zldb.add_backfill_checkpoint(shard_start, shard_end, len(entries))
+                    zldb.db_commit()
+                except:
+                    zldb.db_conn.rollback()
+                    raise
+                print("[{}/{}] {}: {} entries".format(i, len(jobs), shard_start[:7], len(entries)))
+    return failed
+
+def checkpoint_wal(db_path):
+    """Moves the WAL of db_path into the database file and truncates it,
+    so no stale WAL is left next to a file that is being replaced."""
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+def swap(staging_path, db_path):
+    checkpoint_wal(staging_path)
+    if os.path.exists(db_path):
+        checkpoint_wal(db_path)
+    os.replace(staging_path, db_path)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(staging_path + suffix):
+            os.remove(staging_path + suffix)
+
+#-----------------------------------------------#
+def main():
+    today = date.today()
+    end_default = "{:%Y-%m}-{:02d}".format(today, calendar.monthrange(today.year, today.month)[1])
+    import argparse
+    parser = argparse.ArgumentParser(description="rebuild zaim.db from Zaim, resumably and in parallel")
+    parser.add_argument("start", type=str, nargs="?", default="2017-01-01",
+                        help="first day of the history (YYYY-MM-DD)")
+    parser.add_argument("--end", type=str, default=end_default)
+    parser.add_argument("--db", type=str, default="./zaim.db")
+    parser.add_argument("--zaimapikey", type=str, default="zaim_secret.json")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="months fetched at the same time")
+    parser.add_argument("--limits", type=str, default=ratelimit.DEFAULT_LIMITS_PATH,
+                        help="request limits per API and endpoint (JSON)")
+    parser.add_argument("--archive-dir", type=str, default=archive.DEFAULT_ARCHIVE_DIR)
+    parser.add_argument("--no-swap", action="store_true", help="leave the rebuilt database at <db>.backfill")
+    flags = parser.parse_args()
+
+    staging_path = flags.db + ".backfill"
+    response_archive = archive.ResponseArchive(flags.archive_dir) if flags.archive_dir != "" else None
+    ratelimit.set_scheduler(ratelimit.load(flags.limits))
+    z = ZaimAPI(flags.zaimapikey, max_workers=flags.workers, archive=response_archive)
+    started = time.perf_counter()
+    failed = backfill(z, staging_path, flags.start, flags.end, flags.workers)
+    print("fetched in {:.1f} sec".format(time.perf_counter() - started))
+    if failed:
+        print("failed months: {}; rerun to resume".format(", ".join(sorted(failed))))
+        raise SystemExit(1)
+    if flags.no_swap:
+        print("rebuilt database left at {}".format(staging_path))
+        return
+    swap(staging_path, flags.db)
+    print("{} replaced with the rebuilt database".format(flags.db))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import contextlib
+import csv
+import gc
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+import zaim
+from zaimapi import ZaimLocalDB
+
+DEFAULT_SIZES = "1000,10000,100000"
+DEFAULT_THRESHOLD = 0.2
+# stages that keep every row as Python objects need roughly 1KB per row
+DEFAULT_MAX_IN_MEMORY = 1000000
+
+CATEGORIES = [
+    "食費", "食費_alpha", "食費_beta", "日用品", "日用品_alpha", "日用品_beta",
+    "交際費_alpha", "交通費_beta", "水道・光熱", "住まい", "医療・保険_beta",
+    "個人_趣味_alpha", "個人_趣味_beta", "個人_衣服_alpha", "個人_衣服_beta", "個人_その他",
+]
+GENRES = ["食料品", "外食", "カフェ", "消耗品", "電車", "タクシー", "電気代", "家賃", "病院代", "書籍", "洋服"]
+NAMES = ["", "牛乳", "トイレットペーパー", "ランチ", "コーヒー", "定期券", "文庫本", "シャツ"]
+PLACES = ["", "セブンイレブン", "ローソン", "イオン", "スターバックス", "JR東日本", "Amazon"]
+COMMENTS = ["", "", "", "", "dp", "id", "dp\n立替分", "誕生日プレゼント", " id \n後で精算"]
+
+def gen_entries(n, seed=0, start=date(2017, 1, 1)):
+    """Yields n deterministic, realistic money entries, newest first like
+    the Zaim API, with the fields ZaimAPI.get_entries returns."""
+    rnd = random.Random(seed)
+    days = max(1, n // 20)
+    for i in range(n):
+        d = start + timedelta(days=(n - 1 - i) * days // n)
+        category_id = rnd.randrange(len(CATEGORIES))
+        genre_id = rnd.randrange(len(GENRES))
+        yield {
+            "id" : n - i,
+            "user_id" : 1,
+            "receipt_id" : None,
+            "mode" : "payment",
+            "date" : d.isoformat(),
+            "category_id" : category_id,
+            "category" : CATEGORIES[category_id],
+            "genre_id" : genre_id,
+            "genre" : GENRES[genre_id],
+            "amount" : rnd.choice([108, 324, 540, 980, 1200, 3500, 8640, 65000]) + rnd.randrange(100),
+            "currency_code" : "JPY",
+            "name" : rnd.choice(NAMES),
+            "place_uid" : "",
+            "place" : rnd.choice(PLACES),
+            "comment" : rnd.choice(COMMENTS),
+            "created" : "{} 12:00:00".format(d.isoformat()),
+            "active" : 1,
+            "from_account_id" : 1,
+            "to_account_id" : None,
+        }
+
+def write_csv(path, entries):
+    """Writes entries in the layout of a Zaim CSV export."""
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["日付", "方法", "カテゴリ", "カテゴリの内訳", "支払元", "入金先",
+                         "品目", "メモ", "お店", "メモ", "収入", "支出"])
+        for e in entries:
+            writer.writerow([e["date"], "payment", e["category"], e["genre"], "財布", "",
+                             e["name"], "", e["place"], e["comment"], 0, e["amount"]])
+
+def measure(setup, func, memory=True):
+    """Returns (seconds, peak_bytes) of func(setup()).
+
+    The input built by setup is neither timed nor counted in the peak. The
+    time is taken without tracemalloc; the peak is measured in a second
+    run because tracing slows Python code down several times. Input and
+    results are freed before returning.
+    """
+    arg = setup()
+    gc.collect()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        result = func(arg)
+    seconds = time.perf_counter() - start
+    result = None
+    peak = None
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        result = None
+    arg = None
+    gc.collect()
+    return seconds, peak
+
+def summary_append(payments):
+    summary = zaim.PaymentSummary()
+    for p in payments:
+        summary.append(p)
+    return summary
+
+def db_load(path, n, seed):
+    if os.path.exists(path):
+        os.remove(path)
+    with ZaimLocalDB(path) as zldb:
+        return zldb.bulk_load(gen_entries(n, seed))
+
+def run(n, seed, workdir, memory=True, max_in_memory=DEFAULT_MAX_IN_MEMORY):
+    """Runs every stage on n rows. Each stage builds its own input and
+    frees it before the next one; stages that hold one Python object per
+    row are skipped when n > max_in_memory."""
+    csv_path = os.path.join(workdir, "bench_{}.csv".format(n))
+    write_csv(csv_path, gen_entries(n, seed))
+    entries = lambda: list(gen_entries(n, seed))
+    payments = lambda: zaim.gen_payments(entries())
+    batch = lambda: zaim.read_csv(csv_path, columnar=True)
+    # (name, holds one object per row, setup, func)
+    stages = [
+        ("gen_payments", True, entries, zaim.gen_payments),
+        ("gen_payments_columnar", True, entries, lambda e: zaim.gen_payments(e, columnar=True)),
+        ("PaymentSummary.append", True, payments, summary_append),
+        ("gen_reqvalues", True, payments, zaim.gen_reqvalues),
+        ("gen_reqvalues_columnar", True, batch, zaim.gen_reqvalues),
+        ("read_csv", True, lambda: csv_path, zaim.read_csv),
+        ("read_csv_columnar", True, lambda: csv_path, lambda path: zaim.read_csv(path, columnar=True)),
+        ("ZaimLocalDB.update_entries", False, lambda: os.path.join(workdir, "bench.db"),
+         lambda path: db_load(path, n, seed)),
+    ]
+    results = []
+    for name, in_memory, setup, func in stages:
+        if in_memory and n > max_in_memory:
+            print("{:>28} n={:<9d} skipped (> --max-in-memory)".format(name, n), file=sys.stderr)
+            continue
+        seconds, peak = measure(setup, func, memory)
+        results.append({
+            "stage" : name,
+            "rows" : n,
+            "seconds" : seconds,
+            "rows_per_sec" : n / seconds if seconds > 0 else None,
+            "peak_bytes" : peak,
+        })
+        print("{:>28} n={:<9d} {:>12.0f} rows/s  peak {}".format(
+            name, n, results[-1]["rows_per_sec"] or 0,
+            "-" if peak is None else "{:.1f}MB".format(peak / 1024 / 1024)), file=sys.stderr)
+    os.remove(csv_path)
+    return results
+
+def compare(results, baseline, threshold):
+    """Returns the regressions of results against a baseline report."""
+    base = {(r["stage"], r["rows"]) : r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        b = base.get((r["stage"], r["rows"]))
+        if b is None:
+            continue
+        if b["rows_per_sec"] and r["rows_per_sec"] is not None \
+                and r["rows_per_sec"] < b["rows_per_sec"] * (1 - threshold):
+            regressions.append("{} n={}: {:.0f} rows/s < baseline {:.0f}".format(
+                r["stage"], r["rows"], r["rows_per_sec"], b["rows_per_sec"]))
+        if b["peak_bytes"] and r["peak_bytes"] is not None \
+                and r["peak_bytes"] > b["peak_bytes"] * (1 + threshold):
+            regressions.append("{} n={}: peak {} bytes > baseline {}".format(
+                r["stage"], r["rows"], r["peak_bytes"], b["peak_bytes"]))
+    return regressions
+
+#-----------------------------------------------#
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="benchmark zaimtools on synthetic ledgers")
+    parser.add_argument("--sizes", type=str, default=DEFAULT_SIZES,
+                        help="comma separated row counts, e.g. 1000,10000000")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory measurement")
+    parser.add_argument("--max-in-memory", type=int, default=DEFAULT_MAX_IN_MEMORY,
+                        help="skip stages that hold every row as Python objects above this size")
+    parser.add_argument("--output", type=str, default="", help="write the JSON report here")
+    parser.add_argument("--baseline", type=str, default="", help="JSON report to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed relative regression against the baseline")
+    flags = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for n in [int(s) for s in flags.sizes.split(",")]:
+            results.extend(run(n, flags.seed, workdir, not flags.no_memory, flags.max_in_memory))
+    report = {
+        "python" : platform.python_version(),
+        "platform" : platform.platform(),
+        "seed" : flags.seed,
+        "results" : results,
+    }
+    if flags.output:
+        with open(flags.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if flags.baseline:
+        with open(flags.baseline, "r") as f:
+            regressions = compare(results, json.load(f), flags.threshold)
+        for r in regressions:
+            print("REGRESSION:", r, file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
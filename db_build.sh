@@ -6,6 +6,8 @@
 #---------------------#
 function usage {
     echo "usage: $0 YYYY-MM-DD"
+    echo "  rebuilds ${DB_NAME} from Zaim with the history since YYYY-MM-DD;"
+    echo "  rerun it to resume an interrupted rebuild"
 }
 
 #---------------------#
@@ -24,6 +26,4 @@ fi
 
 source bin/activate
 
-rm ${DB_NAME}
-./dbgen.py
-./zaimapi.py $1
+./backfill.py $1 --db ${DB_NAME}
@@ -1,13 +1,30 @@
 #!/usr/bin/env python3
 
+import hashlib
 import sqlite3
+import sys
 
-def dbgen():
-    conn = sqlite3.connect("zaim.db")
-    c = conn.cursor()
+import payrules
+
+def content_hash(*values):
+    """64-bit hash of the columns of a zaim_kakeibo row. Values are hashed
+    as strings, so it does not depend on SQLite's type affinity."""
+    s = "\x1f".join(["\0" if v is None else str(v) for v in values]) + "\x1f"
+    return int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+
+def register_functions(conn):
+    conn.create_function("zaim_content_hash", -1, content_hash, deterministic=True)
+    # Python's str.strip(), which no SQL trim() set matches exactly
+    conn.create_function("zaim_comment_flag", 1, payrules.comment_flag, deterministic=True)
 
+#----------------------------------------#
+# migrations
+#   MIGRATIONS[n] upgrades a database from
+#   user_version n to n + 1.
+#----------------------------------------#
+def _create_kakeibo(c):
     create_table_query = """
-    create table zaim_kakeibo(
+    create table if not exists zaim_kakeibo(
         zaim_id integer primary key not null,
         user_id integer,
         receipt_id integer,
@@ -30,7 +47,202 @@ def dbgen():
     )
     """
     c.execute(create_table_query)
+
+def _add_indexes(c):
+    # year_month ("YYYY-MM") is stored so that month deletes and reports
+    # can use an index instead of scanning with LIKE.
+    c.execute("alter table zaim_kakeibo add column year_month text")
+    c.execute("update zaim_kakeibo set year_month = substr(date, 1, 7)")
+    c.execute("create index if not exists zaim_kakeibo_date on zaim_kakeibo(date)")
+    c.execute("create index if not exists zaim_kakeibo_year_month on zaim_kakeibo(year_month)")
+    c.execute("create index if not exists zaim_kakeibo_category_id on zaim_kakeibo(category_id)")
+    c.execute("create index if not exists zaim_kakeibo_genre_id on zaim_kakeibo(genre_id)")
+    c.execute("create index if not exists zaim_kakeibo_mode_date on zaim_kakeibo(mode, date)")
+    c.execute("""
+    create table if not exists zaim_sync_meta(
+        year_month text primary key not null,
+        last_created text,
+        max_zaim_id integer,
+        synced_at text
+    )
+    """)
+
+def _add_monthly_summary(c):
+    # filled by ZaimLocalDB (see _add_summary_rules); dp is the no_owe
+    # comment flag and half the second payer's share, see payrules.py.
+    c.execute("""
+    create table if not exists monthly_summary(
+        year_month text not null,
+        category text not null,
+        payer integer not null,
+        for_oneself integer not null,
+        dp integer not null,
+        amount integer not null,
+        half integer not null,
+        entries integer not null,
+        first_seen text not null,
+        primary key (year_month, category, payer, for_oneself, dp)
+    )
+    """)
+
+def _add_fulltext_index(c):
+    # trigram FTS5 index over name, place and comment for ZaimLocalDB.search;
+    # trigrams match any substring of 3+ characters, which suits Japanese
+    # text without word boundaries. The triggers keep it in sync with
+    # inserts, REPLACE (needs recursive_triggers) and deletes.
+    try:
+        c.execute("""
+        create virtual table if not exists zaim_kakeibo_fts using fts5(
+            name, place, comment,
+            content='zaim_kakeibo', content_rowid='zaim_id', tokenize='trigram'
+        )
+        """)
+    except sqlite3.OperationalError as e:
+        # SQLite without FTS5 or older than 3.34; search falls back to LIKE
+        print("full-text index not created:", e)
+        return
+    c.execute("""
+    create trigger if not exists zaim_kakeibo_fts_insert after insert on zaim_kakeibo begin
+        insert into zaim_kakeibo_fts(rowid, name, place, comment)
+        values (new.zaim_id, new.name, new.place, new.comment);
+    end
+    """)
+    c.execute("""
+    create trigger if not exists zaim_kakeibo_fts_delete after delete on zaim_kakeibo begin
+        insert into zaim_kakeibo_fts(zaim_kakeibo_fts, rowid, name, place, comment)
+        values ('delete', old.zaim_id, old.name, old.place, old.comment);
+    end
+    """)
+    c.execute("""
+    create trigger if not exists zaim_kakeibo_fts_update after update of name, place, comment on zaim_kakeibo begin
+        insert into zaim_kakeibo_fts(zaim_kakeibo_fts, rowid, name, place, comment)
+        values ('delete', old.zaim_id, old.name, old.place, old.comment);
+        insert into zaim_kakeibo_fts(rowid, name, place, comment)
+        values (new.zaim_id, new.name, new.place, new.comment);
+    end
+    """)
+    c.execute("insert into zaim_kakeibo_fts(zaim_kakeibo_fts) values ('rebuild')")
+
+def _add_backfill_checkpoint(c):
+    # months completed by backfill.py; a month is written together with its
+    # checkpoint, so an interrupted backfill resumes after the last one
+    c.execute("""
+    create table if not exists backfill_checkpoint(
+        year_month text primary key not null,
+        start_date text not null,
+        end_date text not null,
+        entries integer not null,
+        completed_at text not null
+    )
+    """)
+
+def _add_content_hash(c):
+    # zaim_content_hash() of the entry columns (see register_functions);
+    # sync compares it with the fetched entry instead of whole rows
+    c.execute("alter table zaim_kakeibo add column content_hash integer")
+    c.execute("""
+    update zaim_kakeibo set content_hash = zaim_content_hash(
+        zaim_id, user_id, receipt_id, mode, date, category_id, category,
+        genre_id, genre, amount, currency_code, name, place_uid, place,
+        comment, created, active, from_account_id, to_account_id)
+    """)
+
+def _drop_sync_meta(c):
+    # per-month sync watermarks were written by every sync but never read
+    c.execute("drop table if exists zaim_sync_meta")
+
+def _add_summary_rules(c):
+    # the payment rules (payrules.PaymentRules.to_json) monthly_summary was
+    # built with; ZaimLocalDB keeps it on these rules and reads the raw rows
+    # when asked for other ones. Left empty here, so the summary of an
+    # existing database is rebuilt once.
+    c.execute("""
+    create table if not exists summary_rules(
+        id integer primary key check (id = 0),
+        rules text not null
+    )
+    """)
+
+def _reset_summary_rules(c):
+    # the no_owe flag is now taken with zaim_comment_flag(); forgetting the
+    # rules makes ZaimLocalDB rebuild monthly_summary once on open
+    c.execute("delete from summary_rules")
+
+MIGRATIONS = [
+    _create_kakeibo,
+    _add_indexes,
+    _add_monthly_summary,
+    _add_fulltext_index,
+    _add_backfill_checkpoint,
+    _add_content_hash,
+    _add_summary_rules,
+    _drop_sync_meta,
+    _reset_summary_rules,
+]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def migrate(conn):
+    """Upgrades the schema of conn in place to SCHEMA_VERSION.
+
+    Each migration runs in its own transaction together with the bump of
+    PRAGMA user_version, so an interrupted upgrade can simply be rerun.
+    Returns the version the database had before. The SQL functions the
+    schema relies on are registered on conn as well.
+    """
+    register_functions(conn)
+    c = conn.cursor()
+    version = c.execute("PRAGMA user_version").fetchone()[0]
+    if version > SCHEMA_VERSION:
+        raise RuntimeError("zaim.db schema version {} is newer than this program ({})"
+                           .format(version, SCHEMA_VERSION))
     conn.commit()
+    for v in range(version, SCHEMA_VERSION):
+        c.execute("BEGIN")
+        try:
+            MIGRATIONS[v](c)
+            c.execute("PRAGMA user_version = {:d}".format(v + 1))
+            conn.commit()
+        except:
+            conn.rollback()
+            raise
+    return version
+
+def dbgen(db_path="zaim.db"):
+    conn = sqlite3.connect(db_path)
+    old_version = migrate(conn)
     conn.close()
+    if old_version != SCHEMA_VERSION:
+        print("{}: schema version {} -> {}".format(db_path, old_version, SCHEMA_VERSION))
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="create or upgrade zaim.db")
+    parser.add_argument("db_path", type=str, nargs="?", default="zaim.db")
+    parser.add_argument("--rebuild-summary", action="store_true",
+                        help="recompute monthly_summary from the raw rows with --rules")
+    parser.add_argument("--verify-summary", action="store_true",
+                        help="check monthly_summary against the raw rows")
+    parser.add_argument("--rules", type=str, default="",
+                        help="payment rules file for --rebuild-summary")
+    flags = parser.parse_args()
+
+    dbgen(flags.db_path)
+    if not (flags.rebuild_summary or flags.verify_summary):
+        return
+    import payrules
+    from zaimapi import ZaimLocalDB
+    with ZaimLocalDB(flags.db_path) as zldb:
+        if flags.rebuild_summary:
+            rules = payrules.load(flags.rules if flags.rules != "" else payrules.DEFAULT_RULES_PATH)
+            zldb.rebuild_monthly_summary(rules)
+            print("monthly_summary: rebuilt")
+        if flags.verify_summary:
+            mismatches = zldb.verify_monthly_summary()
+            for year_month in mismatches:
+                print("monthly_summary: mismatch in", year_month)
+            if mismatches:
+                sys.exit(1)
+            print("monthly_summary: ok")
 
-dbgen()
+if __name__ == "__main__":
+    main()
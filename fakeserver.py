@@ -0,0 +1,309 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+from bench import CATEGORIES, GENRES, gen_entries
+
+# Local stand-in for the Zaim money/category/genre endpoints and the
+# Sheets v4 calls Gspread makes, for offline load tests:
+#
+#   ./fakeserver.py --port 8080 --entries 100000 --latency 50 --throttle 10
+#   ZAIM_API_BASE=http://localhost:8080/v2 \
+#   SHEETS_API_BASE=http://localhost:8080 ./zaim.py --spreadsheet
+
+def _method(path, http_method, params, request=None):
+    desc = {
+        "id" : "sheets." + path,
+        "path" : path,
+        "httpMethod" : http_method,
+        "parameters" : {},
+        "parameterOrder" : [],
+        "response" : {"$ref" : "Object"},
+    }
+    for name, location, *repeated in params:
+        desc["parameters"][name] = {"type" : "string", "location" : location,
+                                    "required" : location == "path", "repeated" : bool(repeated)}
+        if location == "path":
+            desc["parameterOrder"].append(name)
+    if request:
+        desc["request"] = {"$ref" : "Object"}
+    return desc
+
+def discovery_document(root_url):
+    """Minimal Sheets v4 discovery document served at root_url."""
+    sid = ("spreadsheetId", "path")
+    rng = ("range", "path")
+    return {
+        "kind" : "discovery#restDescription",
+        "discoveryVersion" : "v1",
+        "id" : "sheets:v4",
+        "name" : "sheets",
+        "version" : "v4",
+        "rootUrl" : root_url,
+        "servicePath" : "",
+        "baseUrl" : root_url,
+        "batchPath" : "batch",
+        "parameters" : {},
+        "schemas" : {"Object" : {"id" : "Object", "type" : "object"}},
+        "resources" : {
+            "spreadsheets" : {
+                "methods" : {
+                    "get" : _method("v4/spreadsheets/{spreadsheetId}", "GET",
+                                    [sid, ("fields", "query"), ("ranges", "query")]),
+                    "batchUpdate" : _method("v4/spreadsheets/{spreadsheetId}:batchUpdate", "POST",
+                                            [sid], request=True),
+                },
+                "resources" : {
+                    "values" : {
+                        "methods" : {
+                            "get" : _method("v4/spreadsheets/{spreadsheetId}/values/{range}", "GET",
+                                            [sid, rng, ("valueRenderOption", "query")]),
+                            "append" : _method("v4/spreadsheets/{spreadsheetId}/values/{range}:append",
+                                               "POST", [sid, rng, ("valueInputOption", "query")],
+                                               request=True),
+                            "batchUpdate" : _method("v4/spreadsheets/{spreadsheetId}/values:batchUpdate",
+                                                    "POST", [sid], request=True),
+                            "batchGet" : _method("v4/spreadsheets/{spreadsheetId}/values:batchGet", "GET",
+                                                 [sid, ("ranges", "query", True), ("valueRenderOption", "query")]),
+                        }
+                    }
+                }
+            }
+        },
+    }
+
+def parse_range(range_name):
+    """Returns (sheet title, first row index, first column index) of an A1 range."""
+    title, _, cells = unquote(range_name).rpartition("!")
+    if not title:
+        title, cells = cells, "A1"
+    title = title.strip("'").replace("''", "'")
+    m = re.match(r"([A-Za-z]+)(\d*)", cells)
+    row = int(m.group(2)) - 1 if m and m.group(2) else 0
+    col = 0
+    for c in (m.group(1).upper() if m else "A"):
+        col = col * 26 + ord(c) - ord("A") + 1
+    return title, row, col - 1
+
+class FakeState:
+    def __init__(self, flags):
+        self.flags = flags
+        self.lock = threading.Lock()
+        # newest first, as the Zaim API returns them
+        self.entries = list(gen_entries(flags.entries, flags.seed))
+        self.sheets = {}
+        self.next_sheet_id = 1
+        self.tokens = float(flags.throttle)
+        self.last_refill = time.monotonic()
+        self.requests = 0
+
+    def throttled(self):
+        """Token bucket of --throttle requests per second (0 = unlimited)."""
+        if self.flags.throttle <= 0:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.flags.throttle,
+                              self.tokens + (now - self.last_refill) * self.flags.throttle)
+            self.last_refill = now
+            if self.tokens < 1:
+                return True
+            self.tokens -= 1
+            return False
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None
+
+    def log_message(self, format, *args):
+        if self.state.flags.verbose:
+            super().log_message(format, *args)
+
+    def send_json(self, status, body, headers=()):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in headers:
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def inject_faults(self):
+        """Applies latency, throttling and random errors. Returns True if
+        the request was already answered."""
+        flags = self.state.flags
+        with self.state.lock:
+            self.state.requests += 1
+        if flags.latency > 0:
+            time.sleep(flags.latency / 1000 * random.uniform(0.5, 1.5))
+        if self.state.throttled():
+            self.send_json(429, {"error" : {"code" : 429, "message" : "rate limited"}},
+                           [("Retry-After", "1")])
+            return True
+        if random.random() < flags.error_rate:
+            self.send_json(503, {"error" : {"code" : 503, "message" : "injected error"}})
+            return True
+        return False
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k : v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/$discovery/rest":
+            root = "http://{}:{}/".format(*self.server.server_address[:2])
+            return self.send_json(200, discovery_document(root))
+        if self.inject_faults():
+            return
+        if url.path == "/v2/home/money":
+            return self.send_json(200, {"money" : self.money(query)})
+        if url.path == "/v2/home/category":
+            return self.send_json(200, {"categories" : [{"id" : i, "name" : n} for i, n in enumerate(CATEGORIES)]})
+        if url.path == "/v2/home/genre":
+            return self.send_json(200, {"genres" : [{"id" : i, "name" : n} for i, n in enumerate(GENRES)]})
+        if re.match(r"/v4/spreadsheets/[^/]*/values:batchGet$", url.path):
+            ranges = parse_qs(url.query).get("ranges", [])
+            return self.send_json(200, {"valueRanges" : [self.values_get(r) for r in ranges]})
+        m = re.match(r"/v4/spreadsheets/[^/]*/values/(.+)$", url.path)
+        if m:
+            return self.send_json(200, self.values_get(m.group(1)))
+        m = re.match(r"/v4/spreadsheets/[^/:]*$", url.path)
+        if m:
+            with self.state.lock:
+                sheets = [{"properties" : {"title" : t, "sheetId" : s["id"]}}
+                          for t, s in self.state.sheets.items()]
+            return self.send_json(200, {"sheets" : sheets})
+        self.send_json(404, {"error" : {"code" : 404, "message" : url.path}})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.read_body()
+        if self.inject_faults():
+            return
+        if url.path.endswith(":batchUpdate") and "/values" in url.path:
+            return self.send_json(200, self.values_batch_update(body))
+        if url.path.endswith(":batchUpdate"):
+            return self.spreadsheet_batch_update(body)
+        m = re.match(r"/v4/spreadsheets/[^/]*/values/(.+):append$", url.path)
+        if m:
+            query = {k : v[0] for k, v in parse_qs(url.query).items()}
+            return self.send_json(200, self.values_append(m.group(1), body,
+                                                          query.get("valueInputOption")))
+        self.send_json(404, {"error" : {"code" : 404, "message" : url.path}})
+
+    def money(self, query):
+        start = query.get("start_date", "0000-00-00")
+        end = query.get("end_date", "9999-99-99")
+        page = int(query.get("page", 1))
+        limit = int(query.get("limit", 100))
+        matched = [e for e in self.state.entries if start <= e["date"] <= end]
+        return matched[(page - 1) * limit : page * limit]
+
+    def spreadsheet_batch_update(self, body):
+        with self.state.lock:
+            for req in body.get("requests", []):
+                if "addSheet" in req:
+                    title = req["addSheet"]["properties"]["title"]
+                    if title in self.state.sheets:
+                        return self.send_json(400, {"error" : {"code" : 400,
+                            "message" : "A sheet with the name \"{}\" already exists.".format(title)}})
+                    self.state.sheets[title] = {"id" : self.state.next_sheet_id, "rows" : []}
+                    self.state.next_sheet_id += 1
+                elif "updateCells" in req:
+                    sheet_id = req["updateCells"]["range"]["sheetId"]
+                    for s in self.state.sheets.values():
+                        if s["id"] == sheet_id:
+                            s["rows"] = []
+        self.send_json(200, {"replies" : [{} for _ in body.get("requests", [])]})
+
+    def write_rows(self, range_name, values, append=False, value_input_option=None):
+        title, row, col = parse_range(range_name)
+        if value_input_option == "USER_ENTERED":
+            # store what Sheets would, so FORMULA reads match the real API
+            from gspread import user_entered_value
+            values = [[user_entered_value(v) for v in r] for r in values]
+        sheet = self.state.sheets.setdefault(title, {"id" : -1, "rows" : []})
+        rows = sheet["rows"]
+        if append:
+            row = len(rows)
+        while len(rows) < row + len(values):
+            rows.append([])
+        for i, v in enumerate(values):
+            cells = rows[row + i]
+            cells.extend([""] * (col + len(v) - len(cells)))
+            cells[col : col + len(v)] = v
+        return {"updatedRange" : range_name, "updatedRows" : len(values),
+                "updatedCells" : sum(len(v) for v in values)}
+
+    def values_batch_update(self, body):
+        with self.state.lock:
+            responses = [self.write_rows(d["range"], d.get("values", []),
+                                         value_input_option=body.get("valueInputOption"))
+                         for d in body.get("data", [])]
+        return {"totalUpdatedRows" : sum(r["updatedRows"] for r in responses),
+                "totalUpdatedCells" : sum(r["updatedCells"] for r in responses),
+                "responses" : responses}
+
+    def values_append(self, range_name, body, value_input_option=None):
+        with self.state.lock:
+            return {"updates" : self.write_rows(range_name, body.get("values", []), append=True,
+                                                value_input_option=value_input_option)}
+
+    def values_get(self, range_name):
+        title, row, col = parse_range(range_name)
+        with self.state.lock:
+            rows = self.state.sheets.get(title, {"rows" : []})["rows"][row:]
+            values = [list(r[col:]) for r in rows]
+        # like Sheets, trailing empty cells and rows are left out
+        for r in values:
+            while r and r[-1] in ("", None):
+                r.pop()
+        while values and not any(values[-1]):
+            values.pop()
+        return {"range" : unquote(range_name), "values" : values}
+
+#-----------------------------------------------#
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="fake Zaim and Google Sheets API server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--entries", type=int, default=10000, help="number of money entries served")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=0, help="mean latency per request in ms")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of requests answered with 503")
+    parser.add_argument("--throttle", type=float, default=0,
+                        help="requests per second before answering 429 (0 = unlimited)")
+    parser.add_argument("--verbose", action="store_true")
+    flags = parser.parse_args()
+
+    FakeHandler.state = FakeState(flags)
+    server = ThreadingHTTPServer((flags.host, flags.port), FakeHandler)
+    print("fake Zaim API:   http://{}:{}/v2".format(flags.host, flags.port))
+    print("fake Sheets API: http://{}:{}".format(flags.host, flags.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("requests served:", FakeHandler.state.requests)
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
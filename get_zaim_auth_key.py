@@ -6,6 +6,9 @@ import json
 import requests
 from requests_oauthlib import OAuth1Session
 from requests_oauthlib import OAuth1
+from requests_oauthlib.oauth1_session import TokenRequestDenied
+
+import ratelimit
 
 request_token_url = u"https://api.zaim.net/v2/auth/request"
 authorize_url = u"https://auth.zaim.net/users/auth"
@@ -23,9 +26,21 @@ def get_key():
         consumer_secret = key_data["CONSUMER_SECRET"]
         return consumer_key, consumer_secret 
 
+def fetch_token(endpoint, fetch):
+    """Runs fetch() through the request scheduler, retrying 429 and 5xx."""
+    def send():
+        try:
+            return fetch()
+        except TokenRequestDenied as e:
+            ratelimit.check_status(e.status_code, e.response.headers.get("Retry-After"), error=e)
+            raise
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise ratelimit.RetryableError(0, error=e)
+    return ratelimit.get_scheduler().call("zaim", endpoint, send)
+
 def oauth_requests(consumer_key, consumer_secret):
     auth = OAuth1Session(consumer_key, client_secret=consumer_secret, callback_uri=callback_uri)
-    r = auth.fetch_request_token(request_token_url)
+    r = fetch_token("/v2/auth/request", lambda: auth.fetch_request_token(request_token_url))
     resource_owner_key = r.get('oauth_token')
     resource_owner_secret = r.get('oauth_token_secret')
 
@@ -38,7 +53,7 @@ def oauth_requests(consumer_key, consumer_secret):
                          resource_owner_key=resource_owner_key,
                          resource_owner_secret=resource_owner_secret,
                          verifier=verifier)
-    oauth_token = auth.fetch_access_token(access_token_url)
+    oauth_token = fetch_token("/v2/auth/access", lambda: auth.fetch_access_token(access_token_url))
 
     resource_owner_key = oauth_token.get('oauth_token')
     resource_owner_secret = oauth_token.get('oauth_token_secret')
@@ -1,7 +1,15 @@
+import datetime
 import httplib2
+import json
 import os
+import re
+import time
+
+import metrics
+import ratelimit
 
 from apiclient import discovery
+from apiclient import errors
 from oauth2client import client
 from oauth2client import tools
 from oauth2client.file import Storage
@@ -10,6 +18,117 @@ SCOPES = 'https://www.googleapis.com/auth/spreadsheets'
 CLIENT_SECRET_FILE = 'client_secret.json'
 APPLICATION_NAME = 'My Kakeibo'
 SPREADSHEET_ID = ''
+# Sheets API recommends request payloads of at most 2MB
+MAX_PAYLOAD_BYTES = 2 * 1024 * 1024
+# e.g. SHEETS_API_BASE=http://localhost:8080 for fakeserver.py; the fake
+# server does not check credentials, so no OAuth flow is run for it
+SHEETS_API_BASE = os.environ.get("SHEETS_API_BASE", "")
+DISCOVERY_URL = 'https://sheets.googleapis.com/$discovery/rest?version=v4'
+DISCOVERY_CACHE_FILE = 'sheets_v4_discovery.json'
+DISCOVERY_CACHE_TTL = 7 * 24 * 60 * 60
+
+def load_discovery_document(url, cache_path, ttl=DISCOVERY_CACHE_TTL):
+    """Returns the discovery document at url, cached in cache_path.
+
+    The cache keeps the url and the "revision" of the document; it is
+    refetched after ttl seconds, and a stale copy is used when that fails,
+    so the service can be built offline.
+    """
+    cache = None
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.load(f)
+        if cache["url"] != url:
+            cache = None
+        elif time.time() - cache["fetched_at"] < ttl:
+            return cache["document"]
+    except (OSError, ValueError, KeyError):
+        cache = None
+
+    try:
+        # not retried: a stale copy is better than a slow start
+        resp, content = ratelimit.get_scheduler().call(
+            "sheets", "discovery", lambda: httplib2.Http().request(url))
+        if resp.status != 200:
+            raise IOError("HTTP {}".format(resp.status))
+        document = json.loads(content)
+    except (IOError, OSError, ValueError, httplib2.HttpLib2Error) as e:
+        if cache is None:
+            raise
+        print("discovery document: using revision {} ({})".format(cache["revision"], e))
+        return cache["document"]
+    if cache is None or cache["revision"] != document.get("revision"):
+        print("discovery document: revision {}".format(document.get("revision")))
+    cache = {
+        "url" : url,
+        "revision" : document.get("revision"),
+        "fetched_at" : time.time(),
+        "document" : document,
+    }
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_path, cache_path)
+    return document
+
+DATE_PATTERN = re.compile(r"(\d{4})([-/])(\d{1,2})\2(\d{1,2})")
+NUMBER_PATTERN = re.compile(r"([+-]?)[$¥]?((?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d*)?|\.\d+)([eE][+-]?\d+)?(%?)")
+SERIAL_EPOCH = datetime.date(1899, 12, 30)
+
+def user_entered_value(v):
+    """Returns v as Sheets keeps it when written with USER_ENTERED: dates
+    become serial numbers, "1,000", "¥1,000" and "10%" numbers, "true" and
+    "false" booleans, and a leading apostrophe makes the rest text."""
+    if not isinstance(v, str):
+        return v
+    if v.startswith("'"):
+        return v[1:]
+    s = v.strip()
+    if s.upper() in ("TRUE", "FALSE"):
+        return s.upper() == "TRUE"
+    m = DATE_PATTERN.fullmatch(s)
+    if m:
+        try:
+            return (datetime.date(int(m.group(1)), int(m.group(3)), int(m.group(4))) - SERIAL_EPOCH).days
+        except ValueError:
+            return v
+    m = NUMBER_PATTERN.fullmatch(s)
+    if m:
+        sign, digits, exponent, percent = m.groups()
+        f = float(sign + digits.replace(",", "") + (exponent or ""))
+        if percent:
+            f /= 100
+        return int(f) if f.is_integer() else f
+    return v
+
+def normalize_cell(v):
+    """Maps a cell value as Sheets keeps it (see user_entered_value) and as
+    read back with valueRenderOption=FORMULA to the same string: numbers
+    read back unformatted, and Sheets upper-cases formulas."""
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return str(v).upper()
+    if isinstance(v, (int, float)):
+        return str(int(v)) if float(v).is_integer() else repr(float(v))
+    if v.startswith("="):
+        return v.replace(" ", "").upper()
+    return v
+
+def a1_range(sheet_name, cells=None):
+    """Returns the A1 notation of cells (e.g. "B3") of a sheet, or of the
+    whole sheet; the title is always quoted."""
+    title = "'{}'".format(sheet_name.replace("'", "''"))
+    return title if cells is None else "{}!{}".format(title, cells)
+
+def column_name(index):
+    """0 -> A, 25 -> Z, 26 -> AA"""
+    name = ""
+    index += 1
+    while index:
+        index, r = divmod(index - 1, 26)
+        name = chr(ord("A") + r) + name
+    return name
 
 class Gspread:
     # If modifying these scopes, delete your previously saved credentials
@@ -19,6 +138,7 @@ class Gspread:
         self.flags = flags
         self.spreadsheet_id = SPREADSHEET_ID
         self.credential_name = flags.credential
+        self.scheduler = ratelimit.get_scheduler()
         print("Authentication Start")
         self.service = self.__auth()
         print("Authentication End")
@@ -52,12 +172,19 @@ class Gspread:
         return credentials
 
     def __auth(self):
-        credentials = self.__get_credentials()
-        http = credentials.authorize(httplib2.Http())
-        discoveryUrl = ('https://sheets.googleapis.com/$discovery/rest?'
-                        'version=v4')
-        service = discovery.build('sheets', 'v4', http=http,
-                                  discoveryServiceUrl=discoveryUrl)
+        credential_dir = os.path.join(os.path.abspath(os.path.curdir), '.credentials')
+        if not os.path.exists(credential_dir):
+            os.makedirs(credential_dir)
+        if SHEETS_API_BASE:
+            http = httplib2.Http()
+            discoveryUrl = SHEETS_API_BASE + '/$discovery/rest?version=v4'
+        else:
+            credentials = self.__get_credentials()
+            http = credentials.authorize(httplib2.Http())
+            discoveryUrl = DISCOVERY_URL
+        document = load_discovery_document(discoveryUrl,
+                                           os.path.join(credential_dir, DISCOVERY_CACHE_FILE))
+        service = discovery.build_from_document(document, http=http)
         return service
 
     def create_new_sheet(self, sheet_name):
@@ -74,9 +201,8 @@ class Gspread:
             }
         })
         body = {"requests" : req}
-        resp = self.service.spreadsheets() \
-                           .batchUpdate(spreadsheetId=self.spreadsheet_id, body=body) \
-                           .execute()
+        resp = self.execute(self.service.spreadsheets()
+                                        .batchUpdate(spreadsheetId=self.spreadsheet_id, body=body))
         print("create sheet:", sheet_name, "end")
         req = []
         return resp
@@ -84,12 +210,156 @@ class Gspread:
     def append_data(self, range_name, value_input_option, values):
         print("append data start")
         body = {"values" : values}
-        result = self.service.spreadsheets().values() \
-                                            .append(spreadsheetId=self.spreadsheet_id,
-                                                    body=body,
-                                                    valueInputOption=value_input_option,
-                                                    range=range_name) \
-                                            .execute()
+        result = self.execute(self.service.spreadsheets().values()
+                                          .append(spreadsheetId=self.spreadsheet_id,
+                                                  body=body,
+                                                  valueInputOption=value_input_option,
+                                                  range=range_name))
         print("append data end")
         return result
 
+
+    def execute(self, request):
+        """Executes request through the request scheduler, which retries
+        429 and 5xx."""
+        def send():
+            metrics.REGISTRY.inc("sheets_payload_bytes", len(request.body or ""))
+            try:
+                return request.execute()
+            except errors.HttpError as e:
+                ratelimit.check_status(int(e.resp.status), e.resp.get("retry-after"), error=e)
+                raise
+            except (OSError, httplib2.HttpLib2Error) as e:
+                raise ratelimit.RetryableError(0, error=e)
+        return self.scheduler.call("sheets", getattr(request, "methodId", ""), send)
+
+    def get_sheet_ids(self):
+        """Returns {sheet title: sheetId} of the spreadsheet."""
+        resp = self.execute(self.service.spreadsheets()
+                                        .get(spreadsheetId=self.spreadsheet_id,
+                                             fields="sheets.properties(sheetId,title)"))
+        return {s["properties"]["title"] : s["properties"]["sheetId"] for s in resp.get("sheets", [])}
+
+    def write_sheets(self, sheets, value_input_option="USER_ENTERED"):
+        """Writes `sheets` (an ordered dict of sheet name -> values).
+
+        Missing sheets are added and existing ones are cleared in a single
+        batchUpdate, so rerunning a month overwrites its sheet in place.
+        The values are then written with values.batchUpdate, split into as
+        few payloads of at most MAX_PAYLOAD_BYTES as possible.
+        """
+        print("write sheets start:", ", ".join(sheets))
+        sheet_ids = self.get_sheet_ids()
+        req = []
+        for sheet_name in sheets:
+            if sheet_name in sheet_ids:
+                req.append({
+                    "updateCells" : {
+                        "range" : {"sheetId" : sheet_ids[sheet_name]},
+                        "fields" : "userEnteredValue",
+                    }
+                })
+            else:
+                req.append({
+                    "addSheet" : {
+                        "properties" : {
+                            "title" : sheet_name,
+                        }
+                    }
+                })
+        body = {"requests" : req}
+        resp = self.execute(self.service.spreadsheets()
+                                        .batchUpdate(spreadsheetId=self.spreadsheet_id, body=body))
+        results = []
+        for data in self.__split_payloads((name, 0, 0, values) for name, values in sheets.items()):
+            metrics.REGISTRY.inc("sheets_rows", sum(len(d["values"]) for d in data))
+            body = {"valueInputOption" : value_input_option, "data" : data}
+            results.append(self.execute(self.service.spreadsheets().values()
+                                                    .batchUpdate(spreadsheetId=self.spreadsheet_id,
+                                                                 body=body)))
+        print("write sheets end")
+        return resp, results
+
+    def write_sheets_diff(self, sheets, value_input_option="USER_ENTERED"):
+        """Writes only the cells of `sheets` that differ from the spreadsheet.
+
+        The current values of all sheets are read with one values.batchGet
+        and compared cell by cell (see user_entered_value and normalize_cell);
+        each changed row is sent as one range starting at its first changed
+        cell, and cells that are no longer in the values are blanked. Sheets that do not exist yet are
+        added and written in full.
+        """
+        print("write sheets (diff) start:", ", ".join(sheets))
+        sheet_ids = self.get_sheet_ids()
+        new_sheets = {name : values for name, values in sheets.items() if name not in sheet_ids}
+        results = []
+        if new_sheets:
+            results.append(self.write_sheets(new_sheets, value_input_option))
+        old_sheets = [name for name in sheets if name in sheet_ids]
+        blocks = []
+        if old_sheets:
+            resp = self.execute(self.service.spreadsheets().values()
+                                            .batchGet(spreadsheetId=self.spreadsheet_id,
+                                                      ranges=[a1_range(n) for n in old_sheets],
+                                                      valueRenderOption="FORMULA"))
+            user_entered = value_input_option == "USER_ENTERED"
+            for name, value_range in zip(old_sheets, resp.get("valueRanges", [])):
+                blocks.extend(self.__diff_blocks(name, value_range.get("values", []), sheets[name],
+                                                 user_entered))
+        cells = sum(len(rows[0]) for _, _, _, rows in blocks)
+        metrics.REGISTRY.inc("sheets_cells_changed", cells)
+        print("{} cells in {} ranges changed".format(cells, len(blocks)))
+        for data in self.__split_payloads(blocks):
+            body = {"valueInputOption" : value_input_option, "data" : data}
+            results.append(self.execute(self.service.spreadsheets().values()
+                                                    .batchUpdate(spreadsheetId=self.spreadsheet_id,
+                                                                 body=body)))
+        print("write sheets (diff) end")
+        return results
+
+    def __diff_blocks(self, sheet_name, old, new, user_entered=True):
+        """Yields a one-row block (see __split_payloads) for every row of
+        new that differs from old, spanning the first to the last changed
+        cell."""
+        for i in range(max(len(old), len(new))):
+            old_row = old[i] if i < len(old) else []
+            new_row = list(new[i]) if i < len(new) else []
+            new_row.extend([""] * (len(old_row) - len(new_row)))
+            changed = [j for j, v in enumerate(new_row)
+                       if normalize_cell(user_entered_value(v) if user_entered else v)
+                       != normalize_cell(old_row[j] if j < len(old_row) else "")]
+            if not changed:
+                continue
+            first, last = changed[0], changed[-1]
+            yield sheet_name, i, first, [new_row[first : last + 1]]
+
+    def __split_payloads(self, blocks):
+        """Yields lists of ValueRange dicts whose JSON fits MAX_PAYLOAD_BYTES.
+
+        blocks are (sheet name, first row, first column, rows); a block is
+        split into several ValueRanges when its rows do not fit.
+        """
+        data = []
+        size = 0
+        for sheet_name, start_row, column, values in blocks:
+            rows = []
+            for row in values:
+                row_size = len(json.dumps(row, ensure_ascii=False).encode("utf-8")) + 1
+                if (data or rows) and size + row_size > MAX_PAYLOAD_BYTES:
+                    if rows:
+                        data.append(self.__value_range(sheet_name, start_row, column, rows))
+                        start_row, rows = start_row + len(rows), []
+                    yield data
+                    data, size = [], 0
+                rows.append(row)
+                size += row_size
+            if rows:
+                data.append(self.__value_range(sheet_name, start_row, column, rows))
+        if data:
+            yield data
+
+    def __value_range(self, sheet_name, start_row, column, rows):
+        return {
+            "range" : a1_range(sheet_name, "{}{}".format(column_name(column), start_row + 1)),
+            "values" : rows,
+        }
@@ -11,6 +11,10 @@
 # Before run script:
 #   Change WORKDIR to a path to this script and zaim.py, zaimapi.py, gspread.py
 #
+# To keep the sessions and the DB warm between runs instead, start
+#   ./zaimd.py serve --metrics-dir log &
+# once; it syncs every hour and uploads the sheet on the last day of a month.
+#
 
 #---------------------------------#
 # configuration
@@ -24,13 +28,13 @@ LOGDIR="log"
 cd ${WORKDIR}
 source bin/activate
 
-if [ -e ${LOGDIR} ]; then
+if [ ! -e ${LOGDIR} ]; then
     mkdir ${LOGDIR}
 fi
 
 FILENAME=${LOGDIR}/`date +"%Y%m%d%H%M%S"`.log
 if [ $( date -d '+1 day' +%d ) -eq 1 ]; then
-    ./zaim.py --spreadsheet > $FILENAME 2>&1
+    ./zaim.py --spreadsheet --metrics-dir ${LOGDIR} > $FILENAME 2>&1
 else
-    ./zaim.py > $FILENAME 2>&1
+    ./zaim.py --metrics-dir ${LOGDIR} > $FILENAME 2>&1
 fi
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import contextlib
+import json
+import os
+import threading
+import time
+
+PROM_FILENAME = "zaimtools.prom"
+JSONL_FILENAME = "metrics.jsonl"
+
+class Metrics:
+    """Stage durations and counters of one run.
+
+    Counters are named "<component>_<what>", e.g. zaim_http_requests or
+    sheets_payload_bytes; stages are the steps of zaim.py.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.stages[name] = self.stages.get(name, 0) + elapsed
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self, success=True):
+        with self.lock:
+            return {
+                "started_at" : self.started_at,
+                "duration" : time.time() - self.started_at,
+                "success" : success,
+                "stages" : dict(self.stages),
+                "counters" : dict(self.counters),
+            }
+
+    def to_prometheus(self, success=True):
+        d = self.to_dict(success)
+        lines = []
+        lines.append("# HELP zaimtools_last_run_timestamp_seconds Start time of the last run.")
+        lines.append("# TYPE zaimtools_last_run_timestamp_seconds gauge")
+        lines.append("zaimtools_last_run_timestamp_seconds {:.3f}".format(d["started_at"]))
+        lines.append("# HELP zaimtools_last_run_duration_seconds Wall time of the last run.")
+        lines.append("# TYPE zaimtools_last_run_duration_seconds gauge")
+        lines.append("zaimtools_last_run_duration_seconds {:.6f}".format(d["duration"]))
+        lines.append("# HELP zaimtools_last_run_success 1 if the last run finished without error.")
+        lines.append("# TYPE zaimtools_last_run_success gauge")
+        lines.append("zaimtools_last_run_success {:d}".format(1 if success else 0))
+        lines.append("# HELP zaimtools_stage_duration_seconds Wall time of a stage in the last run.")
+        lines.append("# TYPE zaimtools_stage_duration_seconds gauge")
+        for name, seconds in sorted(d["stages"].items()):
+            lines.append('zaimtools_stage_duration_seconds{{stage="{}"}} {:.6f}'.format(name, seconds))
+        for name, value in sorted(d["counters"].items()):
+            lines.append("# TYPE zaimtools_{} gauge".format(name))
+            lines.append("zaimtools_{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+    def write(self, metrics_dir, success=True):
+        """Appends the run to metrics.jsonl and replaces zaimtools.prom
+        (atomically, for the node_exporter textfile collector)."""
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        with open(os.path.join(metrics_dir, JSONL_FILENAME), "a") as f:
+            f.write(json.dumps(self.to_dict(success)) + "\n")
+        prom_path = os.path.join(metrics_dir, PROM_FILENAME)
+        with open(prom_path + ".tmp", "w") as f:
+            f.write(self.to_prometheus(success))
+        os.replace(prom_path + ".tmp", prom_path)
+
+REGISTRY = Metrics()
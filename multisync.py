@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import calendar
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+import archive
+import payrules
+import ratelimit
+from zaimapi import ZaimAPI, ZaimLocalDB
+
+# Syncs several Zaim accounts (households) concurrently, each into its
+# own database. accounts.json:
+#
+#   {"accounts" : [
+#       {"name" : "home", "zaimapikey" : "zaim_secret_home.json"},
+#       {"name" : "parents", "zaimapikey" : "zaim_secret_parents.json",
+#        "db" : "parents.db", "rules" : "parents_rules.json"}
+#   ]}
+#
+# "db" defaults to zaim_<name>.db and "rules" to payment_rules.json.
+
+DEFAULT_ACCOUNTS_FILE = "accounts.json"
+
+def load_accounts(path):
+    with open(path, "r") as f:
+        accounts = json.load(f)["accounts"]
+    names = [a["name"] for a in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError("account names must be unique: {}".format(names))
+    for a in accounts:
+        a.setdefault("db", "zaim_{}.db".format(a["name"]))
+        a.setdefault("rules", payrules.DEFAULT_RULES_PATH)
+    return accounts
+
+def sync_account(account, start_date, end_date, archive_dir=""):
+    """Fetches one account and syncs it into its own database."""
+    started = time.perf_counter()
+    response_archive = None
+    if archive_dir != "":
+        response_archive = archive.ResponseArchive(os.path.join(archive_dir, account["name"]))
+    z = ZaimAPI(account["zaimapikey"],
+                cache_filename="zaim_idname_cache_{}.json".format(account["name"]),
+                archive=response_archive)
+    entries = z.get_entries(start_date, end_date)
+    with ZaimLocalDB(account["db"], rules=payrules.load(account["rules"])) as zldb:
+        result = zldb.sync_entries(start_date, end_date, entries)
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+def run(accounts, start_date, end_date, workers, archive_dir=""):
+    """Syncs every account on a pool of workers; returns {name : result}.
+
+    A failing account is reported and does not stop the others. The
+    accounts share the limits of the process-wide request scheduler.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(a["name"], executor.submit(sync_account, a, start_date, end_date, archive_dir))
+                   for a in accounts]
+        for name, future in futures:
+            try:
+                results[name] = future.result()
+                print("{}: inserted: {inserted}, updated: {updated}, deleted: {deleted} ({seconds:.2f} sec)"
+                      .format(name, **results[name]))
+            except Exception as e:
+                traceback.print_exc()
+                results[name] = {"error" : repr(e)}
+                print("{}: failed: {!r}".format(name, e))
+    return results
+
+#-----------------------------------------------#
+def main():
+    n = dt.now()
+    start_default = "{}-{:02d}-01".format(n.year, n.month)
+    end_default = "{}-{:02d}-{:02d}".format(n.year, n.month, calendar.monthrange(n.year, n.month)[1])
+    import argparse
+    parser = argparse.ArgumentParser(description="sync several Zaim accounts into per-account databases")
+    parser.add_argument("--accounts", type=str, default=DEFAULT_ACCOUNTS_FILE)
+    parser.add_argument("--start", type=str, default=start_default)
+    parser.add_argument("--end", type=str, default=end_default)
+    parser.add_argument("--workers", type=int, default=4, help="accounts synced at the same time")
+    parser.add_argument("--limits", type=str, default=ratelimit.DEFAULT_LIMITS_PATH,
+                        help="request limits per API and endpoint (JSON), shared by all accounts")
+    parser.add_argument("--archive-dir", type=str, default="",
+                        help="keep raw responses in <archive-dir>/<account name>")
+    flags = parser.parse_args()
+
+    accounts = load_accounts(flags.accounts)
+    ratelimit.set_scheduler(ratelimit.load(flags.limits))
+    started = time.perf_counter()
+    results = run(accounts, flags.start, flags.end, flags.workers, flags.archive_dir)
+    print("{} accounts in {:.2f} sec".format(len(accounts), time.perf_counter() - started))
+    if any("error" in r for r in results.values()):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
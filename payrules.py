@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import json
+import os
+from collections import namedtuple
+
+DEFAULT_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "payment_rules.json")
+DEFAULT_RULES = {
+    # payers are matched in this order; the first marker found in a
+    # category names the payer
+    "payers" : [
+        {"name" : "alpha", "marker" : "_alpha"},
+        {"name" : "beta", "marker" : "_beta"},
+    ],
+    # how a shared payment is split between the first and second payer
+    "ratio" : [1, 1],
+    "self_marker" : "個人_",
+    # first line of a comment
+    "comment_flags" : {
+        "no_owe" : "dp",
+        "paid_by_id" : "id",
+    },
+}
+
+def comment_flag(comment):
+    """The first line of the stripped comment, e.g. the no_owe flag."""
+    return (comment or "").strip().split("\n")[0]
+
+# payer is 0 when no payer marker is found, otherwise 1 + index in payers
+Settlement = namedtuple("Settlement", ["payer", "for_oneself", "normalized_category", "owes"])
+
+class PaymentRules:
+    """Payer/share classification of payments, driven by a rules dict.
+
+    Only a few dozen distinct categories and comment flags exist, so the
+    result of settle() is computed once per (category, flag) pair.
+    """
+    def __init__(self, rules=DEFAULT_RULES):
+        if len(rules["payers"]) != 2:
+            raise ValueError("payment rules need exactly two payers")
+        self.payer_names = [p["name"] for p in rules["payers"]]
+        self.payer_markers = [p["marker"] for p in rules["payers"]]
+        self.first_ratio, self.second_ratio = rules["ratio"]
+        self.self_marker = rules["self_marker"]
+        self.no_owe_flag = rules["comment_flags"]["no_owe"]
+        self.paid_by_id_flag = rules["comment_flags"]["paid_by_id"]
+        self.config = rules
+        self.__settlements = {}
+
+    def to_json(self):
+        """The rules as canonical JSON; equal strings mean equal rules."""
+        return json.dumps(self.config, sort_keys=True, ensure_ascii=False)
+
+    def comment_flag(self, comment):
+        return comment_flag(comment)
+
+    def who_paid(self, category):
+        for i, marker in enumerate(self.payer_markers):
+            if marker in category:
+                return i + 1
+        return 0
+
+    def is_for_oneself(self, category):
+        return self.self_marker in category
+
+    def normalize_category(self, category):
+        for marker in self.payer_markers + [self.self_marker]:
+            category = category.replace(marker, "")
+        return category
+
+    def settle(self, category, flag):
+        key = (category, flag)
+        settlement = self.__settlements.get(key)
+        if settlement is None:
+            for_oneself = self.is_for_oneself(category)
+            settlement = Settlement(self.who_paid(category), for_oneself,
+                                    self.normalize_category(category),
+                                    not for_oneself and flag != self.no_owe_flag)
+            self.__settlements[key] = settlement
+        return settlement
+
+    def second_share(self, price):
+        """Share of a shared price owed by the second payer (floored)."""
+        return price * self.second_ratio // (self.first_ratio + self.second_ratio)
+
+def load(path=DEFAULT_RULES_PATH):
+    """Reads a rules file; the built-in rules are used if it is missing."""
+    if not os.path.exists(path):
+        return PaymentRules()
+    with open(path, "r") as f:
+        return PaymentRules(json.load(f))
+
+RULES = None
+
+def get_rules():
+    global RULES
+    if RULES is None:
+        RULES = load()
+    return RULES
+
+def set_rules(rules):
+    global RULES
+    RULES = rules
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+import metrics
+import zaim
+from archive import ResponseArchive
+from zaimapi import ZaimAPI, ZaimLocalDB
+
+async def run(flags):
+    """Runs fetch -> DB write -> settlement -> upload as a pipeline.
+
+    Sheets authentication and the category/genre maps are loaded while the
+    money shards are being fetched, and each shard goes to the DB writer
+    and the settlement as soon as it arrives, so a run takes about as long
+    as its slowest stage instead of the sum of all of them.
+    """
+    loop = asyncio.get_running_loop()
+    io_pool = ThreadPoolExecutor(max_workers=4)
+    # sqlite3 connections must stay on the thread that opened them
+    db_pool = ThreadPoolExecutor(max_workers=1)
+    try:
+        print("span: ", flags.start, flags.end)
+        sheets_ready = None
+        if flags.spreadsheet:
+            import gspread
+            sheets_ready = loop.run_in_executor(io_pool, gspread.Gspread, flags)
+        response_archive = ResponseArchive(flags.archive_dir) if flags.archive_dir != "" else None
+        z = ZaimAPI(flags.zaimapikey, load_idname=False, archive=response_archive)
+        idname_ready = loop.run_in_executor(io_pool, z.load_idname_dicts)
+        db = await loop.run_in_executor(db_pool, ZaimLocalDB, flags.db)
+
+        print("[1/3] Fetch, update local DB and calc payments")
+        # fetch, DB update and settlement overlap, so the pass is timed as one stage
+        with metrics.REGISTRY.stage("fetch_db_update"):
+            shards = z.iter_shards(flags.start, flags.end, annotate=False)
+            db_writes = []
+            batches = []
+            result = {"inserted" : 0, "updated" : 0, "deleted" : 0, "csv_replaced" : 0}
+            changes = []
+            while True:
+                shard = await loop.run_in_executor(io_pool, next, shards, None)
+                if shard is None:
+                    break
+                shard_start, shard_end, entries = shard
+                await idname_ready
+                await loop.run_in_executor(io_pool, z.annotate_entries, entries)
+                print("shard {} .. {}: {} entries".format(shard_start, shard_end, len(entries)))
+                db_writes.append(loop.run_in_executor(db_pool, db.sync_entries,
+                                                      shard_start, shard_end, entries,
+                                                      "payment", changes))
+                batches.append(zaim.gen_payments(entries, columnar=True))
+            await idname_ready
+
+            for counts in await asyncio.gather(*db_writes):
+                for k, v in counts.items():
+                    result[k] += v
+                    metrics.REGISTRY.inc("db_rows_" + k, v)
+            await loop.run_in_executor(db_pool, db.db_commit)
+            await loop.run_in_executor(db_pool, db.db_close)
+        print("inserted: {inserted}, updated: {updated}, deleted: {deleted}".format(**result))
+        if flags.diff != "":
+            zaim.write_diff(flags.diff, flags.start, flags.end, changes)
+
+        print("[2/3] Calc settlement")
+        with metrics.REGISTRY.stage("settlement"):
+            # shards arrive newest first
+            pay_lists = zaim.PaymentBatch()
+            for batch in reversed(batches):
+                pay_lists.extend(batch)
+            values = zaim.gen_reqvalues(pay_lists)
+        values.append([""])
+        print("")
+
+        if sheets_ready is not None:
+            print("[3/3] Send data to Google Spreadsheet")
+            with metrics.REGISTRY.stage("sheets_upload"):
+                g = await sheets_ready
+                sheet_name = pay_lists.get_date_str() if len(pay_lists) else flags.start[:7]
+                write = g.write_sheets_diff if flags.sheet_diff else g.write_sheets
+                result = await loop.run_in_executor(io_pool, write, {sheet_name : values})
+            print(result)
+    finally:
+        io_pool.shutdown(wait=False)
+        db_pool.shutdown(wait=True)
+
+def main(flags):
+    asyncio.run(run(flags))
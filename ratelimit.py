@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import collections
+import contextlib
+import email.utils
+import json
+import os
+import random
+import threading
+import time
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+import metrics
+
+DEFAULT_LIMITS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "request_limits.json")
+# Limits are keyed by API ("zaim", "sheets") or by "<api>:<endpoint>",
+# e.g. "zaim:/v2/home/money" or "sheets:sheets.spreadsheets.values.batchUpdate";
+# a request takes a token from every bucket that matches it. rate is the
+# highest rate in requests per second; it is halved on each 429 and grows
+# back while requests succeed. concurrency bounds the requests in flight
+# and queue the callers waiting for a slot on top of them; further callers
+# block until one of those finishes, for at most queue_timeout seconds.
+DEFAULT_LIMITS = {
+    # Zaim does not publish its limits
+    "zaim" : {"rate" : 10, "burst" : 10, "concurrency" : 8, "queue" : 64},
+    # Sheets API: 60 requests per minute per user
+    "sheets" : {"rate" : 1, "burst" : 10, "concurrency" : 2, "queue" : 16},
+}
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+MAX_RETRIES = 5
+BASE_DELAY = 1.0
+MAX_DELAY = 64.0
+QUEUE_TIMEOUT = 60.0
+
+class RetryableError(Exception):
+    """Raised by a send() passed to RequestScheduler.call for a throttled
+    or transient failure. status is 0 for connection errors.
+
+    When retries run out, error is raised if set, otherwise result is
+    returned (e.g. a response for the caller's raise_for_status).
+    """
+    def __init__(self, status, retry_after=None, result=None, error=None):
+        super().__init__("HTTP {}".format(status))
+        self.status = status
+        self.retry_after = retry_after
+        self.result = result
+        self.error = error
+
+class SchedulerBusy(RuntimeError):
+    pass
+
+def parse_retry_after(value):
+    """Returns the seconds of a Retry-After header (delay or HTTP date)."""
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def check_status(status, retry_after=None, result=None, error=None):
+    if status in RETRY_STATUSES:
+        raise RetryableError(status, parse_retry_after(retry_after), result, error)
+
+class TokenBucket:
+    """Thread-safe token bucket: at most `rate` requests per second on
+    average, with bursts of up to `burst` requests.
+
+    throttled() halves the rate (down to min_rate) and pauses the bucket;
+    succeeded() raises it back additively, so the bucket settles just
+    below the rate the server accepts.
+    """
+    def __init__(self, rate, burst=1, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.min_rate = float(min_rate) if min_rate is not None else self.max_rate / 16
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.last_refill = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Takes one token, sleeping until one is available. Returns the
+        seconds slept."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    self.last_refill = self.paused_until
+                    wait = self.paused_until - now
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                    self.last_refill = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return waited
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def throttled(self, pause=0.0):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+
+    def succeeded(self):
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 32)
+
+class Limit:
+    def __init__(self, rate=None, burst=1, min_rate=None, concurrency=None, queue=None,
+                 queue_timeout=QUEUE_TIMEOUT):
+        self.bucket = TokenBucket(rate, burst, min_rate) if rate else None
+        self.slots = threading.BoundedSemaphore(concurrency) if concurrency else None
+        self.max_pending = concurrency + queue if concurrency and queue is not None else None
+        self.queue_timeout = queue_timeout
+        self.pending = 0
+
+    def full(self):
+        return self.max_pending is not None and self.pending >= self.max_pending
+
+class RequestScheduler:
+    """Runs the HTTP requests of every API client of the process under
+    shared limits, retrying throttled and transient failures with
+    Retry-After or jittered exponential backoff."""
+    def __init__(self, limits=DEFAULT_LIMITS, max_retries=MAX_RETRIES,
+                 base_delay=BASE_DELAY, max_delay=MAX_DELAY):
+        self.limits = {key : Limit(**conf) for key, conf in limits.items()}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        # notified whenever a call leaves the queue
+        self.dequeued = threading.Condition(self.lock)
+        self.counters = collections.Counter()
+
+    def __count(self, api, name, value=1):
+        with self.lock:
+            self.counters["{}_{}".format(api, name)] += value
+        metrics.REGISTRY.inc("{}_http_{}".format(api, name), value)
+
+    def backoff(self, attempt, retry_after=None):
+        if retry_after is not None:
+            return retry_after + random.uniform(0, self.base_delay)
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, api, endpoint, send):
+        """Returns send() run under the limits of api and api:endpoint.
+
+        send raises RetryableError for responses worth retrying. While
+        too many callers are already waiting, blocks until one of them is
+        done; raises SchedulerBusy if that takes longer than queue_timeout.
+        """
+        limits = [self.limits[k] for k in (api, api + ":" + endpoint) if k in self.limits]
+        start = time.monotonic()
+        with self.dequeued:
+            if any(l.full() for l in limits):
+                deadline = start + min(l.queue_timeout for l in limits if l.full())
+                while any(l.full() for l in limits):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.counters[api + "_rejected"] += 1
+                        metrics.REGISTRY.inc(api + "_http_rejected")
+                        raise SchedulerBusy("{} request queue still full after {:.0f} sec".format(
+                            api, time.monotonic() - start))
+                    self.dequeued.wait(remaining)
+            for l in limits:
+                l.pending += 1
+        queued = time.monotonic() - start
+        if queued > 0.001:
+            self.__count(api, "wait_seconds", queued)
+        try:
+            for attempt in range(self.max_retries + 1):
+                with contextlib.ExitStack() as stack:
+                    for l in limits:
+                        if l.slots is not None:
+                            stack.enter_context(l.slots)
+                    for l in limits:
+                        if l.bucket is not None:
+                            self.__count(api, "wait_seconds", l.bucket.acquire())
+                    self.__count(api, "requests")
+                    try:
+                        result = send()
+                    except RetryableError as e:
+                        retry = e
+                    else:
+                        for l in limits:
+                            if l.bucket is not None:
+                                l.bucket.succeeded()
+                        return result
+                delay = self.backoff(attempt, retry.retry_after)
+                if retry.status == 429:
+                    self.__count(api, "throttled")
+                    for l in limits:
+                        if l.bucket is not None:
+                            l.bucket.throttled(delay)
+                if attempt == self.max_retries:
+                    if retry.error is not None:
+                        raise retry.error
+                    return retry.result
+                self.__count(api, "retries")
+                print("{} {}: HTTP {}, retry in {:.1f} sec".format(api, endpoint, retry.status, delay))
+                time.sleep(delay)
+                self.__count(api, "wait_seconds", delay)
+        finally:
+            with self.dequeued:
+                for l in limits:
+                    l.pending -= 1
+                self.dequeued.notify_all()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        for key, l in self.limits.items():
+            if l.bucket is not None:
+                stats["{}_rate".format(key)] = l.bucket.rate
+        return stats
+
+def load(path=DEFAULT_LIMITS_PATH):
+    """Returns a scheduler with the limits of a JSON file laid over
+    DEFAULT_LIMITS; the defaults are used if the file is missing."""
+    limits = {k : dict(v) for k, v in DEFAULT_LIMITS.items()}
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            for key, conf in json.load(f).items():
+                limits.setdefault(key, {}).update(conf)
+    return RequestScheduler(limits)
+
+SCHEDULER = None
+
+def get_scheduler():
+    global SCHEDULER
+    if SCHEDULER is None:
+        SCHEDULER = load()
+    return SCHEDULER
+
+def set_scheduler(scheduler):
+    global SCHEDULER
+    SCHEDULER = scheduler
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+import payrules
+import zaim
+from zaimapi import ZaimLocalDB
+
+# spaces str.strip() removes, most of which a hand-written SQL trim() set
+# would miss
+SPACES = ["\u1680", "\u2000", "\u2003", "\u200a", "\u2028", "\u2029", "\u202f", "\u205f",
+          "\u3000", "\xa0", "\t", " "]
+CATEGORIES = ["食費", "食費_alpha", "食費_beta", "個人_趣味_alpha", "日用品_beta"]
+
+def gen_entries():
+    entries = []
+    zaim_id = 1
+    for i, space in enumerate(SPACES):
+        for j, comment in enumerate(["dp", "id", "dp\n立替分", "メモ", ""]):
+            for k, category in enumerate(CATEGORIES):
+                entries.append({
+                    "id" : zaim_id, "user_id" : 1, "receipt_id" : None, "mode" : "payment",
+                    "date" : "2018-03-{:02d}".format(1 + (i + j + k) % 28),
+                    "category_id" : k, "category" : category, "genre_id" : 1, "genre" : "食料品",
+                    "amount" : 101 * zaim_id, "currency_code" : "JPY", "name" : "", "place_uid" : "",
+                    "place" : "", "comment" : space + comment + space, "created" : "",
+                    "active" : 1, "from_account_id" : None, "to_account_id" : None,
+                })
+                zaim_id += 1
+    return entries
+
+def totals(summary):
+    return (summary.get_alpha_paid_total(), summary.get_beta_paid_total(),
+            summary.get_alpha_owe_total(), summary.get_beta_owe_total(),
+            summary.get_alpha_self_paid_total(), summary.get_beta_self_paid_total())
+
+class PaymentSqlTest(unittest.TestCase):
+    def setUp(self):
+        payrules.set_rules(payrules.PaymentRules())
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.tmp.name, "zaim.db")
+        self.entries = gen_entries()
+        with ZaimLocalDB(self.db_path) as zldb:
+            zldb.update_entries(self.entries)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def expected(self):
+        summary = zaim.PaymentSummary()
+        for p in zaim.gen_payments(self.entries):
+            summary.append(p)
+        return totals(summary)
+
+    def test_monthly_summary_matches_python(self):
+        self.assertEqual(totals(zaim.summary_from_db("2018-03-01", "2018-03-31", self.db_path)),
+                         self.expected())
+
+    def test_raw_rows_match_python(self):
+        # not whole months, so summarize_payments reads the raw rows
+        self.assertEqual(totals(zaim.summary_from_db("2018-03-01", "2018-03-30", self.db_path)),
+                         totals(self.partial_expected("2018-03-30")))
+
+    def partial_expected(self, end_date):
+        summary = zaim.PaymentSummary()
+        for p in zaim.gen_payments([e for e in self.entries if e["date"] <= end_date]):
+            summary.append(p)
+        return summary
+
+    def test_owe_totals_in_sheet_values(self):
+        values = zaim.gen_reqvalues(zaim.gen_payments(self.entries))
+        owe = {row[0] : row[1] for row in values[:12] if len(row) > 1}
+        expected = self.expected()
+        self.assertEqual(owe["alpha負担額"], expected[2])
+        self.assertEqual(owe["beta負担額"], expected[3])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,19 +5,24 @@
 # python standard library
 #-----------------------------------------------#
 import calendar
-import csv
+import contextlib
+import io
+import json
+import operator
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
+from itertools import repeat
 from datetime import datetime as dt
 
-#-----------------------------------------------#
-# pip
-#-----------------------------------------------#
-from oauth2client import tools
-
 #-----------------------------------------------#
 # my lib
 #-----------------------------------------------#
-import gspread
+import archive
+import metrics
+import payrules
+import ratelimit
+import zaimcsv
 from zaimapi import ZaimAPI, ZaimLocalDB
 
 class Payer(Enum):
@@ -26,22 +31,24 @@ class Payer(Enum):
     beta = 2
 
 class PaymentFmt:
-    Header = []
-    Header.append("日付")
-    Header.append("カテゴリ")
-    Header.append("ジャンル")
-    Header.append("商品名")
-    Header.append("メモ")
-    Header.append("場所")
-    Header.append("支出額")
-    Header.append("alpha支払額")
-    Header.append("beta支払額")
-    Header.append("alpha負担額")
-    Header.append("beta負担額")
-    Header.append("alpha個人用")
-    Header.append("beta個人用")
-    def __init__(self):
-        pass
+    @staticmethod
+    def get_header():
+        alpha, beta = payrules.get_rules().payer_names
+        Header = []
+        Header.append("日付")
+        Header.append("カテゴリ")
+        Header.append("ジャンル")
+        Header.append("商品名")
+        Header.append("メモ")
+        Header.append("場所")
+        Header.append("支出額")
+        Header.append("{}支払額".format(alpha))
+        Header.append("{}支払額".format(beta))
+        Header.append("{}負担額".format(alpha))
+        Header.append("{}負担額".format(beta))
+        Header.append("{}個人用".format(alpha))
+        Header.append("{}個人用".format(beta))
+        return Header
 
 class Payment:
     def __init__(self, date, category, genre, name, comment, place, price):
@@ -59,6 +66,9 @@ class Payment:
         self.alpha_self_paid = 0
         self.beta_self_paid = 0
         self.id_paid = 0
+        rules = payrules.get_rules()
+        self.flag = rules.comment_flag(comment)
+        self.settlement = rules.settle(category, self.flag)
         self._set_paid()
         self._set_owe()
 
@@ -66,53 +76,41 @@ class Payment:
         return " ".join([str(i) for i in self.to_list()])
 
     def _pay_for_myself(self):
-        return "個人_" in self.category
+        return self.settlement.for_oneself
 
     def is_for_oneself(self):
         return self._pay_for_myself()
 
     def _who_paid(self):
-        if "_alpha" in self.category:
-            return Payer.alpha
-        elif "_beta" in self.category:
-            return Payer.beta
-        else:
-            return Payer.UNKNOWN
+        return Payer(self.settlement.payer)
 
     def _paid_by_id(self):
-        if "id" == self.comment.strip().split("\n")[0]:
-            return True
-        else:
-            return False
+        return self.flag == payrules.get_rules().paid_by_id_flag
 
     def get_normalized_category(self):
-        return self.category.replace("_alpha", "").replace("_beta", "").replace("個人_", "")
+        return self.settlement.normalized_category
 
     def _set_paid(self):
-        if self._who_paid() == Payer.alpha:
-            if self._pay_for_myself():
+        payer = self.settlement.payer
+        if payer == Payer.alpha.value:
+            if self.settlement.for_oneself:
                 self.alpha_self_paid += self.price
             else:
                 self.alpha_paid += self.price
-        elif self._who_paid() == Payer.beta:
-            if self._pay_for_myself():
+        elif payer == Payer.beta.value:
+            if self.settlement.for_oneself:
                 self.beta_self_paid += self.price
             else:
                 self.beta_paid += self.price
         else:
-            self.beta_paid = self.price // 2
+            self.beta_paid = payrules.get_rules().second_share(self.price)
             self.alpha_paid = self.price - self.beta_paid
 
     def _set_owe(self):
-        if self._pay_for_myself():
-            return
-
-        if "dp" == self.comment.strip().split("\n")[0]:
+        if not self.settlement.owes:
             return
 
-        category = self.get_normalized_category()
-        genre = self.genre
-        self.beta_owe = self.price // 2
+        self.beta_owe = payrules.get_rules().second_share(self.price)
         self.alpha_owe = self.price - self.beta_owe
 
     def get_date(self):
@@ -199,6 +197,34 @@ class PaymentSummary:
             self.alpha_self_paid += pay.get_alpha_self_paid()
             self.beta_self_paid += pay.get_beta_self_paid()
 
+    def append_group(self, ncat, payer, for_oneself, no_owe, price_sum, share_sum):
+        """Adds the totals of payments that share category rules and the
+        no_owe comment flag.
+
+        price_sum is the sum of their prices and share_sum the sum of the
+        second payer's shares (payrules.PaymentRules.second_share); the
+        result is the same as appending them one by one.
+        """
+        if not for_oneself:
+            self.category_total[ncat] = self.category_total.get(ncat, 0) + price_sum
+            if payer == Payer.alpha:
+                self.alpha_paid += price_sum
+            elif payer == Payer.beta:
+                self.beta_paid += price_sum
+            else:
+                self.alpha_paid += price_sum - share_sum
+                self.beta_paid += share_sum
+            if not no_owe:
+                self.alpha_owe += price_sum - share_sum
+                self.beta_owe += share_sum
+        else:
+            alpha_self_paid = price_sum if payer == Payer.alpha else 0
+            beta_self_paid = price_sum if payer == Payer.beta else 0
+            self.alpha_category_total[ncat] = self.alpha_category_total.get(ncat, 0) + alpha_self_paid
+            self.beta_category_total[ncat] = self.beta_category_total.get(ncat, 0) + beta_self_paid
+            self.alpha_self_paid += alpha_self_paid
+            self.beta_self_paid += beta_self_paid
+
     def get_category_total(self):
         return self.category_total
 
@@ -227,52 +253,259 @@ class PaymentSummary:
         return self.beta_self_paid
 
 
-def read_csv(filename):
-    payments = []
-    with open(filename, "r") as f:
-        reader = csv.reader(f)
-        header = next(f)
-        for r in reader:
-            date = dt.strptime(r[0], "%Y-%m-%d")
-            category = r[2]
-            genre = r[3]
-            name = r[6]
-            place = r[8]
-            comment = r[9]
-            price = int(r[11])
-            payments.append(Payment(date, category, genre, name, comment, place, price))
+class PaymentBatch:
+    """Column-oriented list of payments.
+
+    Dates, prices and the no_owe comment flag are kept in typed arrays
+    and categories as small integer codes; payer and self/shared flags
+    are worked out once per distinct category instead of once per row.
+    Each row also gets a group code (category code and no_owe flag), and
+    prices and second payer's shares are kept per group as well, so
+    totals are one sum() per group. Indexing returns a regular Payment.
+    """
+    def __init__(self):
+        self.dates = array("l")
+        self.prices = array("q")
+        self.category_codes = array("H")
+        self.no_owe_flags = array("b")
+        self.groups = array("L")
+        # group -> (prices, shares), in order of the group's first row
+        self.group_amounts = {}
+        self.genres = []
+        self.names = []
+        self.comments = []
+        self.places = []
+        self.categories = []
+        self.payers = []
+        self.self_flags = []
+        self.normalized_categories = []
+        self.__codes = {}
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getitem__(self, i):
+        return Payment(dt.fromordinal(self.dates[i]), self.categories[self.category_codes[i]],
+                       self.genres[i], self.names[i], self.comments[i], self.places[i],
+                       self.prices[i])
+
+    def __category_code(self, category):
+        code = self.__codes.get(category)
+        if code is None:
+            code = len(self.categories)
+            settlement = payrules.get_rules().settle(category, "")
+            self.__codes[category] = code
+            self.categories.append(category)
+            self.payers.append(Payer(settlement.payer))
+            self.self_flags.append(settlement.for_oneself)
+            self.normalized_categories.append(settlement.normalized_category)
+        return code
+
+    def append(self, date, category, genre, name, comment, place, price):
+        self.dates.append(date.toordinal())
+        self.prices.append(price)
+        rules = payrules.get_rules()
+        code = self.__category_code(category)
+        no_owe = rules.comment_flag(comment) == rules.no_owe_flag
+        group = code * 2 + no_owe
+        self.category_codes.append(code)
+        self.no_owe_flags.append(no_owe)
+        self.groups.append(group)
+        amounts = self.group_amounts.get(group)
+        if amounts is None:
+            amounts = self.group_amounts[group] = (array("q"), array("q"))
+        amounts[0].append(price)
+        amounts[1].append(rules.second_share(price))
+        self.genres.append(genre)
+        self.names.append(name)
+        self.comments.append(comment)
+        self.places.append(place)
+
+    def extend(self, other):
+        """Appends every payment of another PaymentBatch."""
+        codes = [self.__category_code(c) for c in other.categories]
+        self.dates.extend(other.dates)
+        self.prices.extend(other.prices)
+        self.category_codes.extend(array("H", [codes[c] for c in other.category_codes]))
+        self.no_owe_flags.extend(other.no_owe_flags)
+        groups = [codes[g >> 1] * 2 + (g & 1) for g in range(len(other.categories) * 2)]
+        self.groups.extend(array("L", [groups[g] for g in other.groups]))
+        for group, (prices, shares) in other.group_amounts.items():
+            amounts = self.group_amounts.setdefault(groups[group], (array("q"), array("q")))
+            amounts[0].extend(prices)
+            amounts[1].extend(shares)
+        self.genres.extend(other.genres)
+        self.names.extend(other.names)
+        self.comments.extend(other.comments)
+        self.places.extend(other.places)
+
+    def get_date_str(self):
+        d = dt.fromordinal(self.dates[0])
+        return "{}-{:02d}".format(d.year, d.month)
+
+    def summarize(self):
+        """Computes the PaymentSummary totals without building Payments."""
+        summary = PaymentSummary()
+        for group, (prices, shares) in self.group_amounts.items():
+            code, no_owe = divmod(group, 2)
+            summary.append_group(self.normalized_categories[code], self.payers[code],
+                                 self.self_flags[code], no_owe, sum(prices), sum(shares))
+        return summary
+
+    def to_lists(self):
+        """Returns the rows in the layout of Payment.to_list.
+
+        Amount columns depend only on the price and on the payer, self and
+        no_owe flags of the row's group, so they are worked out once per
+        distinct pair; rows are then put together column by column.
+        """
+        date_strs = {}
+        for d in set(self.dates):
+            date = dt.fromordinal(d)
+            date_strs[d] = "{}-{}-{}".format(date.year, date.month, date.day)
+
+        kinds = []
+        group_kinds = []
+        for group in range(len(self.categories) * 2):
+            code, no_owe = divmod(group, 2)
+            kind = (self.payers[code], self.self_flags[code], bool(no_owe))
+            if kind not in kinds:
+                kinds.append(kind)
+            group_kinds.append(kinds.index(kind))
+
+        # one int per (price, kind) pair, so the maps stay in C
+        keys = list(map(operator.add, map(operator.mul, self.prices, repeat(len(kinds))),
+                        map(group_kinds.__getitem__, self.groups)))
+        rules = payrules.get_rules()
+        amounts = {}
+        for key in set(keys):
+            price, kind = divmod(key, len(kinds))
+            payer, for_oneself, no_owe = kinds[kind]
+            half = rules.second_share(price)
+            if payer == Payer.alpha:
+                paid = [0, 0, price, 0] if for_oneself else [price, 0, 0, 0]
+            elif payer == Payer.beta:
+                paid = [0, 0, 0, price] if for_oneself else [0, price, 0, 0]
+            else:
+                paid = [price - half, half, 0, 0]
+            owe = [0, 0] if for_oneself or no_owe else [price - half, half]
+            amounts[key] = [price] + paid[:2] + owe + paid[2:]
+
+        rows = list(map(amounts.__getitem__, keys))
+        return list(map(list, zip(map(date_strs.__getitem__, self.dates),
+                                  map(self.categories.__getitem__, self.category_codes),
+                                  self.genres, self.names, self.comments, self.places,
+                                  *(map(operator.itemgetter(i), rows) for i in range(7)))))
+
+def parse_date(date_str):
+    return dt(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10]))
+
+def read_csv(filename, columnar=False):
+    payments = PaymentBatch() if columnar else []
+    for chunk in zaimcsv.iter_entry_chunks(filename):
+        for r in chunk:
+            args = (parse_date(r["date"]), r["category"], r["genre"],
+                    r["name"], r["comment"], r["place"], r["amount"])
+            if columnar:
+                payments.append(*args)
+            else:
+                payments.append(Payment(*args))
     return payments
 
-def get_data_by_api(apikey_filename, start_date, end_date):
-    z = ZaimAPI(apikey_filename)
+def get_data_by_api(apikey_filename, start_date, end_date, archive_dir=""):
+    response_archive = archive.ResponseArchive(archive_dir) if archive_dir != "" else None
+    z = ZaimAPI(apikey_filename, archive=response_archive)
     print("(1/1) Get data by Zaim REST API")
     entries = z.get_entries(start_date, end_date)
     return entries
 
-def update_local_db(entries, this_month):
-    zldb = ZaimLocalDB("./zaim.db")
-    print("(1/2) delete entries in {}".format(this_month))
-    zldb.delete_entries_by_date(this_month)
-    print("(2/2) update entries in {}".format(this_month))
-    zldb.update_entries(entries)
-
-def gen_payments(entries):
-    payments = []
-    for r in entries[::-1]:
-        date = dt.strptime(r["date"], "%Y-%m-%d")
+def open_replay(archive_dir, start_date, end_date):
+    """Returns an ArchiveReplay of archive_dir; exits with status 1 if any
+    month of the span is not archived."""
+    replay = archive.ArchiveReplay(archive_dir, ZaimAPI.idname_cache_path())
+    missing = replay.missing_months(start_date, end_date)
+    if missing:
+        print("error: not archived in {}: {}".format(archive_dir, ", ".join(missing)))
+        raise SystemExit(1)
+    return replay
+
+def get_data_by_replay(archive_dir, start_date, end_date):
+    replay = open_replay(archive_dir, start_date, end_date)
+    print("(1/1) Replay data from {}".format(archive_dir))
+    entries = replay.get_entries(start_date, end_date)
+    return entries
+
+def update_local_db(entries, start_date, end_date, full_sync=False, db_path="./zaim.db", diff_path=""):
+    with ZaimLocalDB(db_path) as zldb:
+        if full_sync:
+            this_month = start_date[:7]
+            print("(1/2) delete entries in {}".format(this_month))
+            zldb.delete_entries_by_date(this_month)
+            print("(2/2) update entries in {}".format(this_month))
+            zldb.update_entries(entries)
+        else:
+            print("(1/1) sync entries from {} to {}".format(start_date, end_date))
+            changes = []
+            result = zldb.sync_entries(start_date, end_date, entries, diff=changes)
+            for k, v in result.items():
+                metrics.REGISTRY.inc("db_rows_" + k, v)
+            print("inserted: {inserted}, updated: {updated}, deleted: {deleted}".format(**result))
+            if diff_path != "":
+                write_diff(diff_path, start_date, end_date, changes)
+
+def write_diff(path, start_date, end_date, changes):
+    """Writes the changes of a sync as JSON ("-" for stdout)."""
+    diff = {"start" : start_date, "end" : end_date, "changes" : changes}
+    if path == "-":
+        print(json.dumps(diff, ensure_ascii=False))
+        return
+    with open(path, "w") as f:
+        json.dump(diff, f, ensure_ascii=False)
+
+def summary_from_db(start_date, end_date, db_path="./zaim.db"):
+    """Builds the PaymentSummary of a span from zaim.db with SQL aggregates."""
+    summary = PaymentSummary()
+    with ZaimLocalDB(db_path) as zldb:
+        for ncat, payer, for_oneself, no_owe, price_sum, share_sum in zldb.summarize_payments(start_date, end_date):
+            summary.append_group(ncat, Payer(payer), for_oneself, no_owe, price_sum, share_sum)
+    return summary
+
+def read_db(start_date, end_date, db_path="./zaim.db"):
+    payments = PaymentBatch()
+    with ZaimLocalDB(db_path) as zldb:
+        for date, category, genre, name, comment, place, price in zldb.iter_payment_rows(start_date, end_date):
+            payments.append(parse_date(date), category, genre, name, comment, place, price)
+    return payments
+
+def gen_payments(entries, columnar=False, oldest_first=False):
+    """Returns the Payments of entries, oldest first. entries is a list
+    newest first, as Zaim returns them, or any iterable if oldest_first."""
+    payments = PaymentBatch() if columnar else []
+    for r in (entries if oldest_first else entries[::-1]):
+        date = parse_date(r["date"])
         category = r["category"]
         genre = r["genre"]
         name = r["name"]
         place = r["place"]
         price = int(r["amount"])
         comment = r["comment"]
-        payments.append(Payment(date, category, genre, name, comment, place, price))
+        if columnar:
+            payments.append(date, category, genre, name, comment, place, price)
+        else:
+            payments.append(Payment(date, category, genre, name, comment, place, price))
     return payments
 
-def gen_reqvalues(pay_lists):
-    summary = PaymentSummary()
-    for p in pay_lists:
-        summary.append(p)
+def gen_reqvalues(pay_lists, summary=None):
+    if isinstance(pay_lists, PaymentBatch):
+        if summary is None:
+            summary = pay_lists.summarize()
+        rows = pay_lists.to_lists()
+    else:
+        if summary is None:
+            summary = PaymentSummary()
+            for p in pay_lists:
+                summary.append(p)
+        rows = (p.to_list() for p in pay_lists)
 
     alpha_paid = summary.get_alpha_paid_total()
     beta_paid = summary.get_beta_paid_total()
@@ -281,28 +514,29 @@ def gen_reqvalues(pay_lists):
     alpha_self_paid = summary.get_alpha_self_paid_total()
     beta_self_paid = summary.get_beta_self_paid_total()
 
+    alpha, beta = payrules.get_rules().payer_names
     values = []
     values.append(["■支払額"])
-    values.append(["alpha支払い額", alpha_paid, "=sum(h:h)"])
-    values.append(["beta支払い額", beta_paid, "=sum(i:i)"])
+    values.append(["{}支払い額".format(alpha), alpha_paid, "=sum(h:h)"])
+    values.append(["{}支払い額".format(beta), beta_paid, "=sum(i:i)"])
     values.append(["合計", alpha_paid + beta_paid, "=sum(c2:c3)"])
     values.append([""])
     values.append(["■負担額"])
-    values.append(["alpha負担額", alpha_owe, "=sum(j:j)"])
-    values.append(["beta負担額", beta_owe, "=sum(k:k)"])
+    values.append(["{}負担額".format(alpha), alpha_owe, "=sum(j:j)"])
+    values.append(["{}負担額".format(beta), beta_owe, "=sum(k:k)"])
     print("total_paid:", alpha_paid+beta_paid)
-    print("alpha_paid:", alpha_paid)
-    print("beta_paid:", beta_paid)
-    print("alpha_owe:", alpha_owe)
-    print("beta_owe:", beta_owe)
+    print("{}_paid:".format(alpha), alpha_paid)
+    print("{}_paid:".format(beta), beta_paid)
+    print("{}_owe:".format(alpha), alpha_owe)
+    print("{}_owe:".format(beta), beta_owe)
 
     diff = alpha_paid - alpha_owe
     if diff >= 0:
-        print("beta -> alpha:", diff)
-        values.append(["清算(betaからalpha)", diff, "=c2-c7"])
+        print("{} -> {}:".format(beta, alpha), diff)
+        values.append(["清算({}から{})".format(beta, alpha), diff, "=c2-c7"])
     else:
-        print("alpha -> beta:", diff)
-        values.append(["清算(alphaからbeta)", diff, "=c7-c2"])
+        print("{} -> {}:".format(alpha, beta), diff)
+        values.append(["清算({}から{})".format(alpha, beta), diff, "=c7-c2"])
     values.append([""])
 
     values.append(["■カテゴリ別合計"])
@@ -311,23 +545,102 @@ def gen_reqvalues(pay_lists):
     values.append([""])
 
     values.append(["■ 個人会計"])
-    values.append(["alpha個人合計", alpha_self_paid])
+    values.append(["{}個人合計".format(alpha), alpha_self_paid])
     for k, v in summary.get_alpha_category_total().items():
         values.append([k, v])
     values.append([""])
 
-    values.append(["beta個人会計", beta_self_paid])
+    values.append(["{}個人会計".format(beta), beta_self_paid])
     for k, v in summary.get_beta_category_total().items():
         values.append([k, v])
     values.append([""])
 
     values.append(["■全エントリ"])
-    values.append(PaymentFmt.Header)
-    for p in pay_lists:
-        values.append(p.to_list())
+    values.append(PaymentFmt.get_header())
+    values.extend(rows)
 
     return values
 
+def parse_months(spec):
+    """Parses "YYYY-MM..YYYY-MM" into (start_date, end_date, year_months)."""
+    first, _, last = spec.partition("..")
+    last = last or first
+    year, month = int(first[:4]), int(first[5:7])
+    end_year, end_month = int(last[:4]), int(last[5:7])
+    year_months = []
+    while (year, month) <= (end_year, end_month):
+        year_months.append("{}-{:02d}".format(year, month))
+        year, month = (year, month + 1) if month < 12 else (year + 1, 1)
+    if not year_months:
+        raise ValueError("empty month range: {}".format(spec))
+    end_date = "{}-{:02d}".format(end_year, end_month)
+    return (year_months[0] + "-01",
+            "{}-{:02d}".format(end_date, calendar.monthrange(end_year, end_month)[1]),
+            year_months)
+
+def partition_by_month(entries, year_months):
+    months = {ym: [] for ym in year_months}
+    for e in entries:
+        months.setdefault(e["date"][:7], []).append(e)
+    return months
+
+def gen_month_values(entries):
+    """Worker for --months: returns (values, printed text) of one month."""
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        values = gen_reqvalues(gen_payments(entries, columnar=True))
+        values.append([""])
+    return values, out.getvalue()
+
+def run_months(flags):
+    start_date, end_date, year_months = parse_months(flags.months)
+    num_of_steps = 4 if flags.spreadsheet else 3
+    print("span: ", start_date, end_date)
+    if flags.replay:
+        print("[1/{}] Replay data from the archive".format(num_of_steps))
+        with metrics.REGISTRY.stage("replay"):
+            entries = get_data_by_replay(flags.archive_dir, start_date, end_date)
+        print("[2/{}] Skip local DB update".format(num_of_steps))
+    else:
+        print("[1/{}] Get data from Zaim".format(num_of_steps))
+        with metrics.REGISTRY.stage("zaim_fetch"):
+            entries = get_data_by_api(flags.zaimapikey, start_date, end_date, flags.archive_dir)
+        print("[2/{}] Update local DB".format(num_of_steps))
+        with metrics.REGISTRY.stage("db_update"):
+            update_local_db(entries, start_date, end_date, flags.full_sync, flags.db, flags.diff)
+    print("[3/{}] Calc payments of {} months".format(num_of_steps, len(year_months)))
+    with metrics.REGISTRY.stage("settlement"):
+        months = partition_by_month(entries, year_months)
+        sheets = {}
+        # the workers may be spawned, so hand them the rules explicitly
+        with ProcessPoolExecutor(initializer=payrules.set_rules,
+                                 initargs=(payrules.get_rules(),)) as executor:
+            for ym, (values, text) in zip(year_months, executor.map(gen_month_values, [months[ym] for ym in year_months])):
+                print("*** {} ***".format(ym))
+                print(text)
+                sheets[ym] = values
+    if flags.spreadsheet:
+        print("[4/{}] Send data to Google Spreadsheet".format(num_of_steps))
+        with metrics.REGISTRY.stage("sheets_upload"):
+            import gspread
+            g = gspread.Gspread(flags)
+            write = g.write_sheets_diff if flags.sheet_diff else g.write_sheets
+            result = write(sheets)
+        print(result)
+
+def add_oauth_flags(parser):
+    """Adds the flags of oauth2client.tools.argparser, which Gspread hands to
+    tools.run_flow, without importing the Google client libraries."""
+    parser.add_argument("--auth_host_name", default="localhost",
+                        help="Hostname when running a local web server.")
+    parser.add_argument("--noauth_local_webserver", action="store_true", default=False,
+                        help="Do not run a local web server.")
+    parser.add_argument("--auth_host_port", default=[8080, 8090], type=int, nargs="*",
+                        help="Port web server should listen on.")
+    parser.add_argument("--logging_level", default="ERROR",
+                        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL"],
+                        help="Set the logging level of detail.")
+
 #-----------------------------------------------#
 def main():
     n = dt.now()
@@ -335,55 +648,116 @@ def main():
     end_default = "{}-{:02d}-{:02d}".format(n.year, n.month, calendar.monthrange(n.year, n.month)[1])
     try:
         import argparse
-        parent_parser = argparse.ArgumentParser(parents=[tools.argparser])
+        parent_parser = argparse.ArgumentParser()
+        add_oauth_flags(parent_parser)
         parent_parser.add_argument("--credential", type=str, default="sheets.googleapis.my-kakeibo.json")
         parent_parser.add_argument("--start", type=str, default=start_default)
         parent_parser.add_argument("--end", type=str, default=end_default)
         parent_parser.add_argument("--zaimapikey", type=str, default="zaim_secret.json")
         parent_parser.add_argument("--csv", type=str, default="")
         parent_parser.add_argument("--spreadsheet", action="store_true")
+        parent_parser.add_argument("--sheet-diff", action="store_true",
+                                   help="send only the cells that differ from the sheet")
+        parent_parser.add_argument("--full-sync", action="store_true")
+        parent_parser.add_argument("--from-db", action="store_true")
+        parent_parser.add_argument("--db", type=str, default="./zaim.db")
+        parent_parser.add_argument("--diff", type=str, default="",
+                                   help="write the rows the sync changed as JSON here (\"-\" for stdout)")
+        parent_parser.add_argument("--rules", type=str, default=payrules.DEFAULT_RULES_PATH)
+        parent_parser.add_argument("--limits", type=str, default=ratelimit.DEFAULT_LIMITS_PATH,
+                                   help="request limits per API and endpoint (JSON)")
+        parent_parser.add_argument("--pipeline", action="store_true",
+                                   help="overlap fetch, DB update, settlement and upload")
+        parent_parser.add_argument("--months", type=str, default="",
+                                   help="YYYY-MM..YYYY-MM; one sheet per month")
+        parent_parser.add_argument("--metrics-dir", type=str, default="",
+                                   help="write metrics.jsonl and zaimtools.prom here")
+        parent_parser.add_argument("--archive-dir", type=str, default=archive.DEFAULT_ARCHIVE_DIR,
+                                   help="keep raw Zaim responses here (\"\" to disable)")
+        parent_parser.add_argument("--replay", action="store_true",
+                                   help="read entries from --archive-dir instead of Zaim")
         flags = parent_parser.parse_args()
+        if flags.replay and (flags.pipeline or flags.archive_dir == ""):
+            parent_parser.error("--replay needs --archive-dir and does not work with --pipeline")
     except ImportError:
         flags = None
 
+    success = False
+    try:
+        run(flags)
+        success = True
+    finally:
+        if flags.metrics_dir != "":
+            metrics.REGISTRY.write(flags.metrics_dir, success)
+
+def run(flags):
+    payrules.set_rules(payrules.load(flags.rules))
+    ratelimit.set_scheduler(ratelimit.load(flags.limits))
+    if flags.months != "":
+        run_months(flags)
+        return
+    if flags.pipeline:
+        import pipeline
+        pipeline.main(flags)
+        return
+
     print("span: ", flags.start, flags.end)
     if flags.spreadsheet == True:
         num_of_steps = 4
     else:
         num_of_steps = 3
 
+    summary = None
     if flags.csv != "":
         print("************* Start parsing CSV file *************")
-        pay_lists = read_csv(flags.csv)
+        with metrics.REGISTRY.stage("csv_read"):
+            pay_lists = read_csv(flags.csv, columnar=True)
         print("*************  End parsing CSV file  *************")
+    elif flags.replay:
+        print("[1/{}] Replay data from the archive".format(num_of_steps))
+        with metrics.REGISTRY.stage("replay"):
+            replay = open_replay(flags.archive_dir, flags.start, flags.end)
+        print("[2/{}] Skip local DB update".format(num_of_steps))
+        print("[3/{}] Calc payments".format(num_of_steps))
+        with metrics.REGISTRY.stage("settlement"):
+            # one archived month in memory at a time
+            pay_lists = gen_payments(replay.iter_entries(flags.start, flags.end, oldest_first=True),
+                                     columnar=True, oldest_first=True)
+    elif flags.from_db:
+        print("************* Start reading local DB *************")
+        with metrics.REGISTRY.stage("db_read"):
+            summary = summary_from_db(flags.start, flags.end, flags.db)
+            # entry rows are only needed for the sheet
+            if flags.spreadsheet:
+                pay_lists = read_db(flags.start, flags.end, flags.db)
+            else:
+                pay_lists = PaymentBatch()
+        print("*************  End reading local DB  *************")
     else:
         print("[1/{}] Get data from Zaim".format(num_of_steps))
-        entries = get_data_by_api(flags.zaimapikey, flags.start, flags.end)
+        with metrics.REGISTRY.stage("zaim_fetch"):
+            entries = get_data_by_api(flags.zaimapikey, flags.start, flags.end, flags.archive_dir)
         print("[2/{}] Update local DB".format(num_of_steps))
-        this_month = flags.start[:7]
-        update_local_db(entries, this_month)
+        with metrics.REGISTRY.stage("db_update"):
+            update_local_db(entries, flags.start, flags.end, flags.full_sync, flags.db, flags.diff)
         print("[3/{}] Calc payments".format(num_of_steps))
-        pay_lists = gen_payments(entries)
-    values = gen_reqvalues(pay_lists)
+        with metrics.REGISTRY.stage("settlement"):
+            pay_lists = gen_payments(entries, columnar=True)
+    with metrics.REGISTRY.stage("settlement"):
+        values = gen_reqvalues(pay_lists, summary)
     values.append([""])
     print("")
     if flags.spreadsheet:
         print("[4/{}] Send data to Google Spreadsheet".format(num_of_steps))
-        print("sheet_name:", pay_lists[0].get_date_str())
-        #print(values)
-        g = gspread.Gspread(flags)
-        print("(1/2) create a sheet whose name is {}".format(pay_lists[0].get_date_str()))
-        result = g.create_new_sheet(pay_lists[0].get_date_str())
-        print(result) # fixme: check result
-        sheet_name = pay_lists[0].get_date_str()
-        start_column = "A"
-        end_column = chr(ord("A") + len(PaymentFmt.Header))
-        range_name = "{}!{}:{}".format(sheet_name, start_column, end_column)
-        print("range_name:", range_name)
-        value_input_option = "USER_ENTERED"
-        print("(2/2) append data to the sheet")
-        result = g.append_data(range_name, value_input_option, values)
-        print(result) # fixme: check result
+        sheet_name = pay_lists[0].get_date_str() if len(pay_lists) else flags.start[:7]
+        print("sheet_name:", sheet_name)
+        with metrics.REGISTRY.stage("sheets_upload"):
+            import gspread
+            g = gspread.Gspread(flags)
+            print("(1/1) write data to the sheet {}".format(sheet_name))
+            write = g.write_sheets_diff if flags.sheet_diff else g.write_sheets
+            result = write({sheet_name : values})
+        print(result)
 
 if __name__ == "__main__":
     main()
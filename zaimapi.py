@@ -4,9 +4,18 @@
 #----------------------------------------#
 # python standard library
 #----------------------------------------#
+import calendar
+import collections
+import itertools
 import json
+import operator
 import os
 import sqlite3
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
 #----------------------------------------#
 # pip
@@ -14,75 +23,296 @@ import sqlite3
 import requests
 from requests_oauthlib import OAuth1
 
+#----------------------------------------#
+# my lib
+#----------------------------------------#
+import archive
+import dbgen
+import metrics
+import payrules
+import ratelimit
+
+# e.g. ZAIM_API_BASE=http://localhost:8080/v2 for fakeserver.py
+ZAIM_API_BASE = os.environ.get("ZAIM_API_BASE", u"https://api.zaim.net/v2")
+
 class ZaimAPI:
-    GET_MONEY_URL = u"https://api.zaim.net/v2/home/money"
-    GET_CATEGORY_URL = u"https://api.zaim.net/v2/home/category"
-    GET_GENRE_URL = u"https://api.zaim.net/v2/home/genre"
+    GET_MONEY_URL = ZAIM_API_BASE + u"/home/money"
+    GET_CATEGORY_URL = ZAIM_API_BASE + u"/home/category"
+    GET_GENRE_URL = ZAIM_API_BASE + u"/home/genre"
+    PAGE_LIMIT = 100
+    MAX_WORKERS = 4
+    MAX_RETRIES = 3
+    CACHE_TTL = 24 * 60 * 60
 
-    def __init__(self, filename="zaim_secret.json"):
+    def __init__(self, filename="zaim_secret.json", max_workers=MAX_WORKERS,
+                 cache_filename="zaim_idname_cache.json", load_idname=True, api_base=None,
+                 archive=None, scheduler=None):
         credential_dir = os.path.join(os.path.abspath(os.path.curdir), ".credentials")
         credential_path = os.path.join(credential_dir, filename)
         with open(credential_path, "r") as f:
             key_data = json.load(f)
-            ZaimAPI.CONSUMER_KEY = key_data["CONSUMER_KEY"]
-            ZaimAPI.CONSUMER_SECRET = key_data["CONSUMER_SECRET"]
-            ZaimAPI.ACCESS_TOKEN = key_data["ACCESS_TOKEN"]
-            ZaimAPI.ACCESS_TOKEN_SECRET = key_data["ACCESS_TOKEN_SECRET"]
-
-        self.__oauth_header = OAuth1(ZaimAPI.CONSUMER_KEY,
-                                     ZaimAPI.CONSUMER_SECRET,
-                                     ZaimAPI.ACCESS_TOKEN,
-                                     ZaimAPI.ACCESS_TOKEN_SECRET,
+            self.consumer_key = key_data["CONSUMER_KEY"]
+            self.consumer_secret = key_data["CONSUMER_SECRET"]
+            self.access_token = key_data["ACCESS_TOKEN"]
+            self.access_token_secret = key_data["ACCESS_TOKEN_SECRET"]
+
+        self.__oauth_header = OAuth1(self.consumer_key,
+                                     self.consumer_secret,
+                                     self.access_token,
+                                     self.access_token_secret,
                                      signature_type='auth_header')
-        self.categories = self.__gen_idname_dict(ZaimAPI.GET_CATEGORY_URL, "categories")
-        self.genres = self.__gen_idname_dict(ZaimAPI.GET_GENRE_URL, "genres")
+        if api_base is not None:
+            self.GET_MONEY_URL = api_base + u"/home/money"
+            self.GET_CATEGORY_URL = api_base + u"/home/category"
+            self.GET_GENRE_URL = api_base + u"/home/genre"
+        self.max_workers = max_workers
+        # an archive.ResponseArchive that keeps every raw response
+        self.archive = archive
+        # a ratelimit.RequestScheduler; the process-wide one by default
+        self.scheduler = scheduler if scheduler is not None else ratelimit.get_scheduler()
+        self.session = requests.Session()
+        self.session.auth = self.__oauth_header
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.cache_path = self.idname_cache_path(cache_filename)
+        self.__refresh_lock = threading.RLock()
+        self.__unknown_ids = set()
+        self.categories = {}
+        self.genres = {}
+        if load_idname:
+            self.load_idname_dicts()
+
+    @staticmethod
+    def idname_cache_path(cache_filename="zaim_idname_cache.json"):
+        return os.path.join(os.path.abspath(os.path.curdir), ".credentials", cache_filename)
+
+    def load_idname_dicts(self):
+        """Loads the id->name maps from the cache, or from Zaim without one."""
+        fetched_at = self.__load_idname_cache()
+        if fetched_at is None:
+            self.refresh_idname_dicts()
+        elif time.time() - fetched_at > self.CACHE_TTL:
+            threading.Thread(target=self.refresh_idname_dicts, daemon=True).start()
 
     def __gen_idname_dict(self, url, key):
         params = { "mapping" : "1" }
-        r = requests.get(url, auth=self.__oauth_header, params=params)
+        r = self.__get(url, params)
         _d = r.json()[key]
+        if self.archive is not None:
+            self.archive.append(archive.IDNAME_PARTITION, {"kind" : key}, [r.content])
         d = {}
         for i in _d:
             d[i["id"]] = i["name"]
         return d
 
+    def __load_idname_cache(self):
+        """Loads the id->name maps from the cache file.
+
+        Returns the time the maps were fetched, or None if there is no
+        usable cache.
+        """
+        try:
+            with open(self.cache_path, "r") as f:
+                cache = json.load(f)
+            self.categories = {int(k): v for k, v in cache["categories"].items()}
+            self.genres = {int(k): v for k, v in cache["genres"].items()}
+            return cache["fetched_at"]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __save_idname_cache(self):
+        cache = {
+            "fetched_at" : time.time(),
+            "categories" : self.categories,
+            "genres" : self.genres,
+        }
+        tmp_path = self.cache_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, self.cache_path)
+
+    def refresh_idname_dicts(self):
+        with self.__refresh_lock:
+            categories = self.__gen_idname_dict(self.GET_CATEGORY_URL, "categories")
+            genres = self.__gen_idname_dict(self.GET_GENRE_URL, "genres")
+            self.categories = categories
+            self.genres = genres
+            self.__save_idname_cache()
+
+    def __refresh_for_unknown(self, cat_id, genre_id):
+        """Refetches the maps once per id that is missing from them."""
+        if cat_id in self.categories and genre_id in self.genres:
+            return
+        with self.__refresh_lock:
+            unknown = set()
+            if cat_id not in self.categories:
+                unknown.add(("category", cat_id))
+            if genre_id not in self.genres:
+                unknown.add(("genre", genre_id))
+            if not unknown or unknown <= self.__unknown_ids:
+                return
+            self.__unknown_ids |= unknown
+            self.refresh_idname_dicts()
+
     def get_category(self, cat_id):
-        return self.categories[cat_id]
+        return self.categories.get(cat_id, "")
 
     def get_genre(self, genre_id):
-        return self.genres[genre_id]
+        return self.genres.get(genre_id, "")
 
     def get_entries(self, start_date, end_date):
-        params = {
-            "mapping" : "1",
-            "mode" : "payment",
-            "start_date" : start_date,
-            "end_date" : end_date,
-        }
-        r = requests.get(self.GET_MONEY_URL, auth=self.__oauth_header, params=params)
-        entries = r.json()["money"]
+        return list(self.iter_entries(start_date, end_date))
+
+    def iter_entries(self, start_date, end_date):
+        """Yields entries between start_date and end_date (newest first)."""
+        for shard_start, shard_end, entries in self.iter_shards(start_date, end_date):
+            yield from entries
+
+    def iter_shards(self, start_date, end_date, annotate=True):
+        """Yields (shard_start, shard_end, entries) newest first.
+
+        The span is split into month shards which are fetched page by page
+        on a bounded thread pool; shards are yielded in order as soon as
+        each one is complete, so the caller can consume the history while
+        the rest is still being downloaded. With annotate=False the
+        category/genre names are left to annotate_entries.
+        """
+        shards = month_shards(start_date, end_date)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            pending = collections.deque()
+            for shard in shards:
+                pending.append((shard, executor.submit(self.fetch_shard, *shard, annotate=annotate)))
+                if len(pending) >= self.max_workers * 2:
+                    shard, future = pending.popleft()
+                    yield shard + (future.result(),)
+            while pending:
+                shard, future = pending.popleft()
+                yield shard + (future.result(),)
+
+    def fetch_shard(self, start_date, end_date, annotate=True):
+        """Fetches every page of one shard, retrying the shard on a malformed
+        body. HTTP errors are retried per request by the scheduler."""
+        for retry in range(self.MAX_RETRIES + 1):
+            try:
+                entries, bodies = self.__fetch_pages(start_date, end_date)
+                break
+            except (ValueError, KeyError):
+                if retry == self.MAX_RETRIES:
+                    raise
+                metrics.REGISTRY.inc("zaim_http_retries")
+                time.sleep(2 ** retry)
+        if self.archive is not None:
+            self.archive.append(start_date[:7], {"start_date" : start_date, "end_date" : end_date}, bodies)
+        if annotate:
+            self.annotate_entries(entries)
+        return entries
+
+    def annotate_entries(self, entries):
+        """Sets the "category" and "genre" names of fetched entries."""
         for e in entries:
+            self.__refresh_for_unknown(e["category_id"], e["genre_id"])
             e["category"] = self.get_category(e["category_id"])
             e["genre"] = self.get_genre(e["genre_id"])
-        return entries
+
+    def __get(self, url, params):
+        def send():
+            try:
+                r = self.session.get(url, params=params)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                raise ratelimit.RetryableError(0, error=e)
+            metrics.REGISTRY.inc("zaim_response_bytes", len(r.content))
+            ratelimit.check_status(r.status_code, r.headers.get("Retry-After"), result=r)
+            return r
+        return self.scheduler.call("zaim", urllib.parse.urlsplit(url).path, send)
+
+    def __fetch_pages(self, start_date, end_date):
+        """Returns the entries of a span and the raw body of each page."""
+        entries = []
+        bodies = []
+        page = 1
+        while True:
+            params = {
+                "mapping" : "1",
+                "mode" : "payment",
+                "start_date" : start_date,
+                "end_date" : end_date,
+                "page" : page,
+                "limit" : self.PAGE_LIMIT,
+            }
+            r = self.__get(self.GET_MONEY_URL, params)
+            r.raise_for_status()
+            money = r.json()["money"]
+            metrics.REGISTRY.inc("zaim_rows", len(money))
+            entries.extend(money)
+            bodies.append(r.content)
+            if len(money) < self.PAGE_LIMIT:
+                return entries, bodies
+            page += 1
 
     def dump_json(self, start_date, end_date):
-        if self.entries == False:
-            self.get_entries(start_date, end_date)
+        entries = self.get_entries(start_date, end_date)
         with open("output_{}_{}.json".format(start_date, end_date), "w") as f:
-            json.dump(self.entries, f)
+            json.dump(entries, f, ensure_ascii=False)
+
+def month_shards(start_date, end_date):
+    """Splits [start_date, end_date] ("YYYY-MM-DD") into month spans.
+
+    Spans are returned newest first, the same order Zaim returns entries in.
+    """
+    start = date(*[int(i) for i in start_date.split("-")])
+    end = date(*[int(i) for i in end_date.split("-")])
+    shards = []
+    year, month = end.year, end.month
+    while (year, month) >= (start.year, start.month):
+        first = max(date(year, month, 1), start)
+        last = min(date(year, month, calendar.monthrange(year, month)[1]), end)
+        shards.append((first.isoformat(), last.isoformat()))
+        year, month = (year, month - 1) if month > 1 else (year - 1, 12)
+    return shards
 
 class ZaimLocalDB:
-    def __init__(self, db_path="./zaim.db"):
+    BATCH_SIZE = 10000
+    CACHE_SIZE = -64000 # in KiB when negative, i.e. 64MB
+
+    def __init__(self, db_path="./zaim.db", batch_size=BATCH_SIZE, cache_size=CACHE_SIZE, rules=None):
         self.db_path = os.path.abspath(db_path)
+        # the payment queries classify with these rules; monthly_summary
+        # keeps the rules it was built with (see summary_rules)
+        self.rules = rules if rules is not None else payrules.get_rules()
+        self.__summary_rules = None
         self.db_conn = sqlite3.connect(self.db_path)
         self.db_cursor = self.db_conn.cursor()
+        self.batch_size = batch_size
+        self.exec_query("PRAGMA journal_mode = WAL")
+        self.exec_query("PRAGMA synchronous = NORMAL")
+        self.exec_query("PRAGMA cache_size = {:d}".format(cache_size))
+        # REPLACE must fire the delete triggers for the row it replaces
+        self.exec_query("PRAGMA recursive_triggers = ON")
+        dbgen.migrate(self.db_conn)
+        self.__create_dirty_month_triggers()
+        if self.summary_rules() is None:
+            self.rebuild_monthly_summary()
+            self.db_commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db_commit()
+        else:
+            self.db_conn.rollback()
+        self.db_close()
+        return False
 
     def db_commit(self):
+        self.flush_monthly_summary()
         self.db_conn.commit()
 
     def db_close(self):
-        self.db_close()
+        self.db_conn.close()
 
     def exec_query(self, q, k=None):
         if k == None:
@@ -91,80 +321,433 @@ class ZaimLocalDB:
             self.db_cursor.execute(q, k)
 
     def delete_entries_by_date(self, start_year_month):
-        delete_query = 'DELETE FROM zaim_kakeibo where date like "{}%"'.format(start_year_month)
-        self.exec_query(delete_query)
+        delete_query = "DELETE FROM zaim_kakeibo WHERE year_month = ?"
+        self.exec_query(delete_query, (start_year_month,))
 
     def update_entries(self, entries):
+        """Writes entries with executemany in batches of batch_size.
+
+        entries may be any iterable (e.g. a generator) of entry dicts; only
+        one batch is held in memory at a time. Nothing is committed here.
+        Returns the number of written rows.
+        """
         insert_query = """
         REPLACE INTO zaim_kakeibo
-            (
-                zaim_id,
-                user_id,
-                receipt_id,
-                mode,
-                date,
-                category_id,
-                category,
-                genre_id,
-                genre,
-                amount,
-                currency_code,
-                name,
-                place_uid,
-                place,
-                comment,
-                created,
-                active,
-                from_account_id,
-                to_account_id
-            )
+            ({}, year_month, content_hash)
         VALUES
-            (
-                ?, ?, ?, ?, ?,
-                ?, ?, ?, ?, ?,
-                ?, ?, ?, ?, ?,
-                ?, ?, ?, ?
-            )
-          """
-        keys = [
-                "id",
-                "user_id",
-                "receipt_id",
-                "mode",
-                "date",
-                "category_id",
-                "category",
-                "genre_id",
-                "genre",
-                "amount",
-                "currency_code",
-                "name",
-                "place_uid",
-                "place",
-                "comment",
-                "created",
-                "active",
-                "from_account_id",
-                "to_account_id"
-               ]
+            ({}, substr(?{:d}, 1, 7), ?)
+          """.format(", ".join(ENTRY_COLUMNS), ", ".join(["?"] * len(ENTRY_COLUMNS)),
+                     ENTRY_COLUMNS.index("date") + 1)
+        to_row = operator.itemgetter(*ENTRY_KEYS)
+        # hashed here rather than with zaim_content_hash() in the statement,
+        # which saves SQLite converting every row's values for the callback
+        rows = (row + (dbgen.content_hash(*row),) for row in map(to_row, entries))
+        count = 0
+        while True:
+            batch = list(itertools.islice(rows, self.batch_size))
+            if not batch:
+                return count
+            self.db_cursor.executemany(insert_query, batch)
+            count += len(batch)
+
+    def bulk_load(self, entries):
+        """Loads entries in one explicit transaction.
+
+        Either every entry is stored or, if loading fails or the process
+        dies part-way, none of them is. The dirty-month insert trigger is
+        dropped for the load and monthly_summary recomputed for the loaded
+        months once at the end. Into an empty table, the indexes and the
+        full-text index triggers are dropped as well, and both are rebuilt
+        once at the end, which is several times faster than row by row;
+        into a non-empty table the triggers index the new rows as usual.
+        """
+        months = set()
+        def track(entries):
+            for e in entries:
+                months.add(e["date"][:7])
+                yield e
+        if not self.db_conn.in_transaction:
+            self.exec_query("BEGIN")
+        try:
+            self.__drop_dirty_month_insert_trigger()
+            self.exec_query("SELECT NOT EXISTS (SELECT 1 FROM zaim_kakeibo)")
+            indexes = []
+            fts_triggers = []
+            if self.db_cursor.fetchone()[0]:
+                self.exec_query("""
+                SELECT name, sql FROM sqlite_master
+                WHERE type = 'index' AND tbl_name = 'zaim_kakeibo' AND sql IS NOT NULL
+                """)
+                indexes = self.db_cursor.fetchall()
+                for name, _ in indexes:
+                    self.exec_query("DROP INDEX {}".format(name))
+                self.exec_query("""
+                SELECT name, sql FROM sqlite_master
+                WHERE type = 'trigger' AND tbl_name = 'zaim_kakeibo' AND name LIKE 'zaim_kakeibo_fts_%'
+                """)
+                fts_triggers = self.db_cursor.fetchall()
+                for name, _ in fts_triggers:
+                    self.exec_query("DROP TRIGGER {}".format(name))
+            count = self.update_entries(track(entries))
+            for _, sql in indexes:
+                self.exec_query(sql)
+            if fts_triggers:
+                self.exec_query("INSERT INTO zaim_kakeibo_fts(zaim_kakeibo_fts) VALUES ('rebuild')")
+                for _, sql in fts_triggers:
+                    self.exec_query(sql)
+            self.db_cursor.executemany("INSERT OR IGNORE INTO dirty_months VALUES (?)",
+                                       [(m,) for m in months])
+            self.db_commit()
+        except:
+            self.db_conn.rollback()
+            raise
+        finally:
+            self.__create_dirty_month_triggers()
+        return count
+
+    def __create_dirty_month_triggers(self):
+        """Records the months touched by this connection in temp.dirty_months."""
+        self.exec_query("CREATE TEMP TABLE IF NOT EXISTS dirty_months(year_month text primary key)")
+        for event, months in (("INSERT", ["new"]), ("DELETE", ["old"]), ("UPDATE", ["old", "new"])):
+            self.exec_query("""
+            CREATE TEMP TRIGGER IF NOT EXISTS zaim_kakeibo_dirty_{0} AFTER {1} ON main.zaim_kakeibo
+            BEGIN
+                {2}
+            END
+            """.format(event.lower(), event, "\n".join(
+                "INSERT OR IGNORE INTO dirty_months VALUES ({}.year_month);".format(m) for m in months)))
+
+    def summary_rules(self):
+        """Returns the payrules.PaymentRules monthly_summary was built with,
+        or None for a summary of unknown rules."""
+        self.exec_query("SELECT rules FROM summary_rules")
+        row = self.db_cursor.fetchone()
+        if row is None:
+            return None
+        if self.__summary_rules is None or self.__summary_rules.to_json() != row[0]:
+            self.__summary_rules = payrules.PaymentRules(json.loads(row[0]))
+        return self.__summary_rules
+
+    def __drop_dirty_month_insert_trigger(self):
+        # the delete trigger stays: it is cheap and marks the month of a
+        # row that REPLACE removes, which may differ from the new row's
+        self.exec_query("DROP TRIGGER IF EXISTS temp.zaim_kakeibo_dirty_insert")
+
+    def __refresh_monthly_summary(self, rules, where, args=()):
+        self.exec_query("DELETE FROM monthly_summary WHERE {}".format(where), args)
+        self.exec_query("INSERT INTO monthly_summary " + monthly_summary_select(rules, where), args)
+
+    def flush_monthly_summary(self):
+        """Recomputes monthly_summary for the months changed since the
+        last flush, inside the current transaction, with the rules the
+        summary was built with rather than this connection's rules."""
+        self.exec_query("SELECT count(*) FROM dirty_months")
+        if self.db_cursor.fetchone()[0] == 0:
+            return
+        self.__refresh_monthly_summary(self.summary_rules(),
+                                       "year_month IN (SELECT year_month FROM dirty_months)")
+        self.exec_query("DELETE FROM dirty_months")
+
+    def rebuild_monthly_summary(self, rules=None):
+        """Recomputes all of monthly_summary with rules (this connection's
+        rules by default) and records them."""
+        rules = rules if rules is not None else self.rules
+        self.__refresh_monthly_summary(rules, "1")
+        self.exec_query("REPLACE INTO summary_rules (id, rules) VALUES (0, ?)", (rules.to_json(),))
+        self.exec_query("DELETE FROM dirty_months")
+
+    def verify_monthly_summary(self):
+        """Returns the months whose monthly_summary rows differ from the raw rows."""
+        self.flush_monthly_summary()
+        self.exec_query("""
+        SELECT year_month FROM (
+            SELECT * FROM monthly_summary
+            EXCEPT {0}
+        )
+        UNION
+        SELECT year_month FROM (
+            {0}
+            EXCEPT SELECT * FROM monthly_summary
+        )
+        ORDER BY year_month
+        """.format(monthly_summary_select(self.summary_rules(), "1")))
+        return [r[0] for r in self.db_cursor.fetchall()]
+
+    def sync_entries(self, start_date, end_date, entries, mode="payment", diff=None):
+        """Applies fetched entries of [start_date, end_date] as a delta.
+
+        Each fetched entry is compared with the stored content_hash of its
+        row: new entries are inserted, entries whose hash changed are
+        replaced, and local entries that Zaim no longer returns are marked
+        active = 0. Unchanged rows are not written at all, and rows
+        imported from a CSV export are dropped from the span. The whole
+        span is still fetched and compared: Zaim lets entries of any month
+        be edited, so only the local writes are a delta.
+
+        If diff is a list, a record of every change is appended to it
+        (see _diff_record). Returns the number of inserted, updated and
+        deleted rows and of the CSV rows replaced.
+        """
+        self.exec_query("""
+        SELECT zaim_id, content_hash, active FROM zaim_kakeibo
+        WHERE date BETWEEN ? AND ? AND mode = ? AND zaim_id > 0
+        """, (start_date, end_date, mode))
+        local = {zaim_id : (h, active) for zaim_id, h, active in self.db_cursor.fetchall()}
+
+        changed = {"inserted" : [], "updated" : []}
         for entry in entries:
-            key = [entry[k] for k in keys]
-            self.exec_query(insert_query, key)
+            row = [entry[k] for k in ENTRY_KEYS]
+            old = local.pop(entry["id"], None)
+            if old is None:
+                changed["inserted"].append(row)
+            elif old[0] != dbgen.content_hash(*row):
+                changed["updated"].append(row)
+        deleted = [(zaim_id,) for zaim_id, (h, active) in local.items() if str(active) != "0"]
+
+        if diff is not None:
+            old_rows = self.__get_rows([row[0] for row in changed["updated"]] + [d[0] for d in deleted])
+            for row in changed["inserted"]:
+                diff.append(_diff_record("insert", None, row))
+            for row in changed["updated"]:
+                diff.append(_diff_record("update", old_rows[row[0]], row))
+            for (zaim_id,) in deleted:
+                diff.append(_diff_record("delete", old_rows[zaim_id], None))
+
+        self.update_entries(dict(zip(ENTRY_KEYS, row))
+                            for row in changed["inserted"] + changed["updated"])
+        self.db_cursor.executemany("""
+        UPDATE zaim_kakeibo SET active = 0, content_hash = zaim_content_hash({})
+        WHERE zaim_id = ?
+        """.format(", ".join("0" if c == "active" else c for c in ENTRY_COLUMNS)), deleted)
+        # rows imported from a CSV export (negative ids, see zaimcsv.py)
+        # stand in for months not synced yet; the API's entries replace them
+        self.exec_query("DELETE FROM zaim_kakeibo WHERE date BETWEEN ? AND ? AND zaim_id < 0",
+                        (start_date, end_date))
+        csv_replaced = self.db_cursor.rowcount
+        return {
+            "inserted" : len(changed["inserted"]),
+            "updated" : len(changed["updated"]),
+            "deleted" : len(deleted),
+            "csv_replaced" : csv_replaced,
+        }
+
+    def __get_rows(self, zaim_ids):
+        """Returns {zaim_id : row} of the given ids, in ENTRY_COLUMNS order."""
+        rows = {}
+        for i in range(0, len(zaim_ids), 500):
+            chunk = zaim_ids[i : i + 500]
+            self.exec_query("SELECT {} FROM zaim_kakeibo WHERE zaim_id IN ({})".format(
+                ", ".join(ENTRY_COLUMNS), ", ".join(["?"] * len(chunk))), chunk)
+            rows.update((r[0], r) for r in self.db_cursor)
+        return rows
+
+    def api_months(self):
+        """Returns the set of months that hold entries synced from Zaim's API."""
+        self.exec_query("SELECT DISTINCT year_month FROM zaim_kakeibo WHERE zaim_id > 0")
+        return {r[0] for r in self.db_cursor}
+
+    def backfill_checkpoints(self):
+        """Returns {year_month : (start_date, end_date)} of backfilled months."""
+        self.exec_query("SELECT year_month, start_date, end_date FROM backfill_checkpoint")
+        return {ym : (start, end) for ym, start, end in self.db_cursor}
+
+    def add_backfill_checkpoint(self, start_date, end_date, entries):
+        self.exec_query("""
+        REPLACE INTO backfill_checkpoint (year_month, start_date, end_date, entries, completed_at)
+        VALUES (?, ?, ?, ?, datetime('now'))
+        """, (start_date[:7], start_date, end_date, entries))
+
+    def summarize_payments(self, start_date, end_date):
+        """Aggregates the settlement of [start_date, end_date] in SQL.
+
+        Returns one row per (normalized category, payer, for_oneself, no_owe)
+        with the sum of the amounts and of the second payer's shares, ordered by
+        first appearance. zaim.summary_from_db turns them into a
+        PaymentSummary. Spans of whole months are read from
+        monthly_summary instead of the raw rows when it was built with the
+        same rules.
+        """
+        summary_rules = self.summary_rules()
+        if (is_month_start(start_date) and is_month_end(end_date) and
+                summary_rules is not None and summary_rules.to_json() == self.rules.to_json()):
+            self.flush_monthly_summary()
+            self.exec_query("""
+            SELECT category, payer, for_oneself, dp, sum(amount), sum(half)
+            FROM monthly_summary
+            WHERE year_month BETWEEN ? AND ?
+            GROUP BY 1, 2, 3, 4
+            ORDER BY min(first_seen)
+            """, (start_date[:7], end_date[:7]))
+            return self.db_cursor.fetchall()
+        self.exec_query("""
+        SELECT {ncat}, {payer}, {for_oneself}, coalesce({no_owe}, 0), sum(amount), sum({share})
+        FROM zaim_kakeibo
+        WHERE date BETWEEN ? AND ? AND {where}
+        GROUP BY 1, 2, 3, 4
+        ORDER BY min({first_seen})
+        """.format(**payment_sql(self.rules)), (start_date, end_date))
+        return self.db_cursor.fetchall()
+
+    def iter_payment_rows(self, start_date, end_date):
+        """Yields (date, category, genre, name, comment, place, amount)."""
+        self.exec_query("""
+        SELECT date, category, genre, name, comment, place, amount
+        FROM zaim_kakeibo
+        WHERE date BETWEEN ? AND ? AND {where}
+        ORDER BY date, zaim_id
+        """.format(**payment_sql(self.rules)), (start_date, end_date))
+        yield from self.db_cursor
+
+    def has_fulltext_index(self):
+        self.exec_query("SELECT 1 FROM sqlite_master WHERE name = 'zaim_kakeibo_fts'")
+        return self.db_cursor.fetchone() is not None
+
+    def search(self, query, start_date="0000-00-00", end_date="9999-99-99", limit=50):
+        """Finds active entries whose name, place or comment contain every
+        whitespace separated term of query.
+
+        Terms of 3 or more characters are looked up in the trigram index
+        and ranked with bm25; shorter terms, which trigrams cannot match,
+        are checked with LIKE. Returns (rows, totals): rows are dicts of the
+        best `limit` matches, totals the count and amount of all matches,
+        overall and per category.
+        """
+        terms = query.split()
+        if not terms:
+            raise ValueError("empty search query")
+        use_index = self.has_fulltext_index()
+        indexed = [t for t in terms if use_index and len(t) >= SEARCH_MIN_TERM]
+        where = ["k.active = 1", "k.date BETWEEN ? AND ?"]
+        args = [start_date, end_date]
+        for t in terms:
+            if t in indexed:
+                continue
+            pattern = "%" + t.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            where.append("(" + " OR ".join("k.{} LIKE ? ESCAPE '\\'".format(col)
+                                           for col in SEARCH_COLUMNS) + ")")
+            args.extend([pattern] * len(SEARCH_COLUMNS))
+        if indexed:
+            source = "zaim_kakeibo_fts f JOIN zaim_kakeibo k ON k.zaim_id = f.rowid"
+            where.insert(0, "zaim_kakeibo_fts MATCH ?")
+            args.insert(0, " AND ".join('"{}"'.format(t.replace('"', '""')) for t in indexed))
+            order = "f.rank"
+        else:
+            source = "zaim_kakeibo k"
+            order = "k.date DESC, k.zaim_id DESC"
+        where = " AND ".join(where)
+
+        self.exec_query("""
+        SELECT k.zaim_id, k.date, k.amount, k.category, k.genre, k.name, k.place, k.comment
+        FROM {} WHERE {} ORDER BY {} LIMIT ?
+        """.format(source, where, order), args + [limit])
+        columns = [d[0] for d in self.db_cursor.description]
+        rows = [dict(zip(columns, r)) for r in self.db_cursor.fetchall()]
+
+        self.exec_query("""
+        SELECT k.category, count(*), sum(k.amount)
+        FROM {} WHERE {} GROUP BY k.category ORDER BY sum(k.amount) DESC
+        """.format(source, where), args)
+        by_category = [{"category" : c, "entries" : n, "amount" : a} for c, n, a in self.db_cursor]
+        totals = {
+            "entries" : sum(c["entries"] for c in by_category),
+            "amount" : sum(c["amount"] for c in by_category),
+            "by_category" : by_category,
+        }
+        return rows, totals
+
+# shorter terms cannot be matched with trigrams
+SEARCH_MIN_TERM = 3
+SEARCH_COLUMNS = ["name", "place", "comment"]
+
+ENTRY_COLUMNS = [
+    "zaim_id",
+    "user_id",
+    "receipt_id",
+    "mode",
+    "date",
+    "category_id",
+    "category",
+    "genre_id",
+    "genre",
+    "amount",
+    "currency_code",
+    "name",
+    "place_uid",
+    "place",
+    "comment",
+    "created",
+    "active",
+    "from_account_id",
+    "to_account_id",
+]
+ENTRY_KEYS = ["id"] + ENTRY_COLUMNS[1:]
+
+# SQL versions of the payrules.PaymentRules classification, evaluated per
+# row. payer is the value of zaim.Payer, no_owe is true when the comment
+# flag (zaim_comment_flag, see dbgen.register_functions) is the no_owe flag,
+# and share is the second payer's share of amount (floor division, as in
+# Python).
+
+def _sql_str(s):
+    return "'{}'".format(s.replace("'", "''"))
+
+def payment_sql(rules):
+    payer = "CASE"
+    for i, marker in enumerate(rules.payer_markers):
+        payer += " WHEN instr(category, {}) > 0 THEN {:d}".format(_sql_str(marker), i + 1)
+    payer += " ELSE 0 END"
+    ncat = "category"
+    for marker in rules.payer_markers + [rules.self_marker]:
+        ncat = "replace({}, {}, '')".format(ncat, _sql_str(marker))
+    scaled = "(amount * {:d})".format(rules.second_ratio)
+    total_ratio = rules.first_ratio + rules.second_ratio
+    return {
+        "payer" : payer,
+        "for_oneself" : "instr(category, {}) > 0".format(_sql_str(rules.self_marker)),
+        "ncat" : ncat,
+        "no_owe" : "zaim_comment_flag(comment) = {}".format(_sql_str(rules.no_owe_flag)),
+        "share" : "({0} - (({0} % {1:d}) + {1:d}) % {1:d}) / {1:d}".format(scaled, total_ratio),
+        "first_seen" : "date || printf(' %020d', zaim_id)",
+        "where" : "mode = 'payment' AND active = 1",
+    }
+
+def monthly_summary_select(rules, months):
+    """Rows of monthly_summary for the months selected by the SQL condition
+    months. The dp and half columns hold no_owe and share."""
+    return """
+    SELECT year_month, coalesce({ncat}, ''), {payer}, coalesce({for_oneself}, 0), coalesce({no_owe}, 0),
+           coalesce(sum(amount), 0), coalesce(sum({share}), 0), count(*), min({first_seen})
+    FROM zaim_kakeibo
+    WHERE {where} AND year_month IS NOT NULL AND ({months})
+    GROUP BY 1, 2, 3, 4, 5
+    """.format(months=months, **payment_sql(rules))
+
+def is_month_start(date_str):
+    return date_str[8:10] == "01"
+
+def is_month_end(date_str):
+    year, month, day = [int(i) for i in date_str.split("-")]
+    return day == calendar.monthrange(year, month)[1]
+
+def _diff_record(op, old, new):
+    """A compact JSON-able record of one change made by sync_entries.
+
+    Inserts carry the non-empty fields of the entry, updates only the
+    fields that changed as [old, new], and deletes just the id and date.
+    """
+    row = new if new is not None else old
+    record = {"op" : op, "id" : row[0], "date" : row[ENTRY_COLUMNS.index("date")]}
+    if op == "insert":
+        record["entry"] = {k : v for k, v in zip(ENTRY_KEYS[1:], new[1:]) if v not in (None, "")}
+    elif op == "update":
+        record["changes"] = {k : [o, n] for k, o, n in zip(ENTRY_KEYS[1:], old[1:], new[1:])
+                             if (None if o is None else str(o)) != (None if n is None else str(n))}
+    return record
 
 def main():
-    import datetime, sys
-    if len(sys.argv) == 2:
-        start_date = sys.argv[1]
-    else:
-        start_date = "2017-01-01"
-    print(start_date)
-    sys.exit(1)
-    z = ZaimAPI()
-    today = datetime.datetime.today()
-    this_month = datetime.datetime(today.year, today.month, 1)
-    last_month = this_month + datetime.timedelta(days = -1)
-    entries = z.get_entries(start_date, last_month.strftime("%Y-%m-%d"))
-    z.update_db()
+    # ./zaimapi.py YYYY-MM-DD is kept for old scripts; see backfill.py
+    import backfill
+    backfill.main()
 
 if __name__ == "__main__":
     main()
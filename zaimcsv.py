@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import collections
+import csv
+import hashlib
+import itertools
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+from zaimapi import ZaimLocalDB
+
+CHUNK_SIZE = 10000
+
+# column positions in a Zaim CSV export
+COL_DATE = 0
+COL_MODE = 1
+COL_CATEGORY = 2
+COL_GENRE = 3
+COL_NAME = 6
+COL_PLACE = 8
+COL_COMMENT = 9
+COL_PRICE = 11
+# values of the 方法 column for payments; income and transfer rows carry
+# their amount in other columns and are left out by import_csv
+PAYMENT_MODES = ("payment", "支出")
+
+def iter_csv_rows(filename):
+    """Yields (ordinal, row) for every data row of a Zaim CSV export.
+
+    CSV exports have no entry id, so ordinal numbers identical rows of the
+    same day; together with the row content it gives a stable id even when
+    a later export contains more rows.
+    """
+    with open(filename, "r", newline="") as f:
+        reader = csv.reader(f)
+        next(reader)
+        seen = collections.Counter()
+        current_date = None
+        for r in reader:
+            if r[COL_DATE] != current_date:
+                current_date = r[COL_DATE]
+                seen.clear()
+            key = tuple(r)
+            yield seen[key], r
+            seen[key] += 1
+
+def csv_entry_id(row, ordinal):
+    """Negative ids keep CSV entries apart from the ids Zaim assigns."""
+    digest = hashlib.sha1("\x1f".join(row + [str(ordinal)]).encode("utf-8")).digest()
+    return -(int.from_bytes(digest[:8], "big") >> 1)
+
+def parse_row(ordinal, r):
+    """Maps a CSV row to the entry fields ZaimLocalDB.update_entries uses."""
+    return {
+        "id" : csv_entry_id(r, ordinal),
+        "user_id" : None,
+        "receipt_id" : None,
+        "mode" : "payment",
+        "date" : r[COL_DATE],
+        "category_id" : None,
+        "category" : r[COL_CATEGORY],
+        "genre_id" : None,
+        "genre" : r[COL_GENRE],
+        "amount" : int(r[COL_PRICE]),
+        "currency_code" : None,
+        "name" : r[COL_NAME],
+        "place_uid" : None,
+        "place" : r[COL_PLACE],
+        "comment" : r[COL_COMMENT],
+        "created" : None,
+        "active" : 1,
+        "from_account_id" : None,
+        "to_account_id" : None,
+    }
+
+def parse_chunk(chunk, payments_only=False):
+    return [parse_row(ordinal, r) for ordinal, r in chunk
+            if not payments_only or r[COL_MODE] in PAYMENT_MODES]
+
+def iter_entry_chunks(filename, chunk_size=CHUNK_SIZE, processes=0, payments_only=False):
+    """Yields the entries of a CSV export as lists of at most chunk_size;
+    with payments_only, rows whose 方法 is not in PAYMENT_MODES are left out.
+
+    With processes > 0 the chunks are parsed on a process pool; only a
+    few chunks are in flight at a time so memory stays constant.
+    """
+    rows = iter_csv_rows(filename)
+    raw_chunks = iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+    if processes <= 0:
+        for chunk in raw_chunks:
+            yield parse_chunk(chunk, payments_only)
+        return
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        pending = collections.deque()
+        for chunk in raw_chunks:
+            pending.append(executor.submit(parse_chunk, chunk, payments_only))
+            if len(pending) >= processes * 2:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def import_csv(filename, db_path="./zaim.db", chunk_size=CHUNK_SIZE, processes=0):
+    """Loads a CSV export into zaim.db. Returns (rows, skipped months, seconds).
+
+    Only payment rows are stored. CSV entries cannot be matched with the entries Zaim's API returns, so
+    months that already hold API rows are skipped rather than stored
+    twice. A later API sync of a month replaces its CSV rows in turn
+    (see ZaimLocalDB.sync_entries).
+    """
+    start = time.perf_counter()
+    chunks = iter_entry_chunks(filename, chunk_size, processes, payments_only=True)
+    with ZaimLocalDB(db_path, batch_size=chunk_size) as zldb:
+        synced = zldb.api_months()
+        skipped = set()
+        def entries():
+            for e in itertools.chain.from_iterable(chunks):
+                if e["date"][:7] in synced:
+                    skipped.add(e["date"][:7])
+                else:
+                    yield e
+        rows = zldb.bulk_load(entries())
+    return rows, sorted(skipped), time.perf_counter() - start
+
+#-----------------------------------------------#
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="import a Zaim CSV export into zaim.db")
+    parser.add_argument("csv", type=str)
+    parser.add_argument("--db", type=str, default="./zaim.db")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument("--processes", type=int, default=0)
+    flags = parser.parse_args()
+
+    rows, skipped, seconds = import_csv(flags.csv, flags.db, flags.chunk_size, flags.processes)
+    print("imported rows:", rows)
+    if skipped:
+        print("skipped months already synced from Zaim:", ", ".join(skipped))
+    print("elapsed: {:.2f} sec".format(seconds))
+    print("throughput: {:.0f} rows/sec".format(rows / seconds if seconds > 0 else 0))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import calendar
+import json
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+import traceback
+from datetime import date
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+import archive
+import metrics
+import payrules
+import ratelimit
+import zaim
+from zaimapi import ZaimAPI, ZaimLocalDB
+
+# Resident replacement for running kakeibo.sh from cron:
+#
+#   ./zaimd.py serve --interval 3600 &
+#   ./zaimd.py sync --spreadsheet    # run a sync now and wait for it
+#   ./zaimd.py status
+#   ./zaimd.py stop
+
+DEFAULT_SOCKET = "zaimd.sock"
+DEFAULT_INTERVAL = 60 * 60
+
+def this_month(today):
+    last_day = calendar.monthrange(today.year, today.month)[1]
+    return "{:%Y-%m}-01".format(today), "{:%Y-%m}-{:02d}".format(today, last_day)
+
+def is_last_day(today):
+    return today.day == calendar.monthrange(today.year, today.month)[1]
+
+class ZaimDaemon:
+    """Keeps the Zaim session, the id->name maps, the DB connection and the
+    Sheets service of one process warm between syncs.
+
+    All syncs run on the worker thread, which also owns the sqlite3
+    connection; the scheduler and the socket only queue jobs for it.
+    """
+    def __init__(self, flags):
+        self.flags = flags
+        self.jobs = queue.Queue()
+        self.stopping = threading.Event()
+        self.state = {"started_at" : time.time(), "syncs" : 0, "last_sync" : None,
+                      "last_result" : None, "last_error" : None}
+        payrules.set_rules(payrules.load(flags.rules))
+        ratelimit.set_scheduler(ratelimit.load(flags.limits))
+        response_archive = archive.ResponseArchive(flags.archive_dir) if flags.archive_dir != "" else None
+        self.zaim = ZaimAPI(flags.zaimapikey, archive=response_archive)
+        self.idname_loaded_at = time.time()
+        self.gspread = None
+        self.db = None
+        # sheets uploaded since the last sync that changed their month
+        self.uploaded = set()
+
+    def sheets(self):
+        if self.gspread is None:
+            import gspread
+            self.gspread = gspread.Gspread(self.flags)
+        return self.gspread
+
+    def sync(self, spreadsheet):
+        """Syncs this month into the DB and optionally uploads its sheet.
+
+        spreadsheet is True, False or "changed"; the last uploads the sheet
+        only if the month changed since its last upload.
+        """
+        metrics.REGISTRY = metrics.Metrics()
+        success = False
+        try:
+            result = self.__sync(spreadsheet)
+            success = True
+            return result
+        finally:
+            if self.flags.metrics_dir != "":
+                metrics.REGISTRY.write(self.flags.metrics_dir, success)
+
+    def __sync(self, spreadsheet):
+        today = date.today()
+        start_date, end_date = this_month(today)
+        if time.time() - self.idname_loaded_at > ZaimAPI.CACHE_TTL:
+            self.zaim.load_idname_dicts()
+            self.idname_loaded_at = time.time()
+        print("sync {} .. {}".format(start_date, end_date))
+        with metrics.REGISTRY.stage("zaim_fetch"):
+            entries = self.zaim.get_entries(start_date, end_date)
+        with metrics.REGISTRY.stage("db_update"):
+            try:
+                changes = []
+                result = self.db.sync_entries(start_date, end_date, entries, diff=changes)
+                self.db.db_commit()
+            except Exception:
+                self.db.db_conn.rollback()
+                raise
+        for k, v in result.items():
+            metrics.REGISTRY.inc("db_rows_" + k, v)
+        print("inserted: {inserted}, updated: {updated}, deleted: {deleted}".format(**result))
+        result["changes"] = changes
+        sheet_name = start_date[:7]
+        if changes or result["csv_replaced"]:
+            self.uploaded.discard(sheet_name)
+        if spreadsheet == "changed" and sheet_name in self.uploaded:
+            print("{}: no changes since the last upload".format(sheet_name))
+        elif spreadsheet:
+            with metrics.REGISTRY.stage("settlement"):
+                pay_lists = zaim.gen_payments(entries, columnar=True)
+                values = zaim.gen_reqvalues(pay_lists)
+            values.append([""])
+            with metrics.REGISTRY.stage("sheets_upload"):
+                result["sheets"] = str(self.sheets().write_sheets_diff({sheet_name : values}))
+            self.uploaded.add(sheet_name)
+        return result
+
+    def work(self):
+        """Worker thread: runs queued syncs until stopped."""
+        self.db = ZaimLocalDB(self.flags.db)
+        try:
+            while True:
+                job = self.jobs.get()
+                if job is None:
+                    return
+                spreadsheet, replies = job
+                try:
+                    result = self.sync(spreadsheet)
+                    self.state["last_result"] = result
+                    self.state["last_error"] = None
+                    reply = {"ok" : True, "result" : result}
+                except Exception as e:
+                    traceback.print_exc()
+                    self.state["last_error"] = repr(e)
+                    reply = {"ok" : False, "error" : repr(e)}
+                self.state["syncs"] += 1
+                self.state["last_sync"] = time.time()
+                if replies is not None:
+                    replies.put(reply)
+        finally:
+            self.db.db_close()
+
+    def schedule(self):
+        """Queues a sync every --interval seconds; on the last day of a
+        month the sheet is uploaded as well, as kakeibo.sh does, unless
+        nothing changed since the last upload."""
+        while not self.stopping.is_set():
+            self.jobs.put(("changed" if is_last_day(date.today()) else False, None))
+            self.stopping.wait(self.flags.interval)
+
+    def stop(self):
+        self.stopping.set()
+        self.jobs.put(None)
+
+    def serve(self):
+        worker = threading.Thread(target=self.work)
+        worker.start()
+        threading.Thread(target=self.schedule, daemon=True).start()
+
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                request = json.loads(self.rfile.readline() or b"{}")
+                command = request.get("command")
+                if command == "sync":
+                    replies = queue.Queue()
+                    daemon.jobs.put((request.get("spreadsheet", False), replies))
+                    reply = replies.get()
+                elif command == "status":
+                    reply = dict(daemon.state, ok=True, pending=daemon.jobs.qsize(),
+                                 requests=ratelimit.get_scheduler().stats())
+                elif command == "stop":
+                    reply = {"ok" : True}
+                    threading.Thread(target=server.shutdown).start()
+                else:
+                    reply = {"ok" : False, "error" : "unknown command: {}".format(command)}
+                self.wfile.write((json.dumps(reply, ensure_ascii=False) + "\n").encode("utf-8"))
+
+        if os.path.exists(self.flags.socket):
+            os.remove(self.flags.socket)
+        server = socketserver.ThreadingUnixStreamServer(self.flags.socket, Handler)
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        print("zaimd: listening on {}".format(self.flags.socket))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.remove(self.flags.socket)
+            self.stop()
+            worker.join()
+            print("zaimd: stopped")
+
+def send_command(socket_path, request):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with s.makefile("rb") as f:
+            return json.loads(f.readline())
+
+#-----------------------------------------------#
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="resident Zaim sync daemon")
+    zaim.add_oauth_flags(parser)
+    parser.add_argument("command", nargs="?", choices=["serve", "sync", "status", "stop"], default="serve")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET)
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="seconds between syncs")
+    parser.add_argument("--spreadsheet", action="store_true", help="sync: also upload this month's sheet")
+    parser.add_argument("--credential", type=str, default="sheets.googleapis.my-kakeibo.json")
+    parser.add_argument("--zaimapikey", type=str, default="zaim_secret.json")
+    parser.add_argument("--db", type=str, default="./zaim.db")
+    parser.add_argument("--rules", type=str, default=payrules.DEFAULT_RULES_PATH)
+    parser.add_argument("--limits", type=str, default=ratelimit.DEFAULT_LIMITS_PATH)
+    parser.add_argument("--archive-dir", type=str, default=archive.DEFAULT_ARCHIVE_DIR)
+    parser.add_argument("--metrics-dir", type=str, default="")
+    flags = parser.parse_args()
+
+    if flags.command == "serve":
+        ZaimDaemon(flags).serve()
+        return
+    request = {"command" : flags.command}
+    if flags.command == "sync":
+        request["spreadsheet"] = flags.spreadsheet
+    reply = send_command(flags.socket, request)
+    print(json.dumps(reply, ensure_ascii=False, indent=2))
+    if not reply.get("ok"):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
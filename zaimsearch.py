@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#fileencoding: utf-8
+
+#-----------------------------------------------#
+# python standard library
+#-----------------------------------------------#
+import json
+import time
+
+#-----------------------------------------------#
+# my lib
+#-----------------------------------------------#
+from zaimapi import ZaimLocalDB
+
+# ./zaimsearch.py スターバックス
+# ./zaimsearch.py "イオン 牛乳" --start 2018-01-01 --end 2018-12-31
+
+def first_line(s):
+    return (s or "").strip().split("\n")[0]
+
+#-----------------------------------------------#
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="search entries of zaim.db by name, place and comment")
+    parser.add_argument("query", type=str, help="whitespace separated terms; all must match")
+    parser.add_argument("--db", type=str, default="./zaim.db")
+    parser.add_argument("--start", type=str, default="0000-00-00")
+    parser.add_argument("--end", type=str, default="9999-99-99")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--json", action="store_true")
+    flags = parser.parse_args()
+
+    started = time.perf_counter()
+    with ZaimLocalDB(flags.db) as zldb:
+        rows, totals = zldb.search(flags.query, flags.start, flags.end, flags.limit)
+    seconds = time.perf_counter() - started
+
+    if flags.json:
+        print(json.dumps({"rows" : rows, "totals" : totals}, ensure_ascii=False, indent=2))
+        return
+    for r in rows:
+        print("{}  {:>9,d}  {}  {}  {}  {}".format(r["date"], r["amount"], r["category"],
+                                                 r["name"], r["place"], first_line(r["comment"])))
+    print("")
+    for c in totals["by_category"]:
+        print("{:>9,d}  {:>6d} entries  {}".format(c["amount"], c["entries"], c["category"]))
+    print("total: {:,d} in {:d} entries ({:.3f} sec)".format(totals["amount"], totals["entries"], seconds))
+
+if __name__ == "__main__":
+    main()